@@ -6,30 +6,59 @@ import logging
 from haversine import haversine
 from opencage.geocoder import OpenCageGeocode, RateLimitExceededError
 
+from autopial_lib.Controller.Downsampling import SCALAR_FIELDS, simplify_track
+from autopial_lib.Controller.Geocoding import GeocodeCache, as_geocode_cache
+from autopial_lib.Controller.GeocodingPool import GeocodingPool
+from autopial_lib.Controller.SessionStatistics import SessionStatistics
+from autopial_lib.metrics import metrics
+
 key = '17d3fa34ccb04d42b9292c191ae4d0b8'
 geocoder = OpenCageGeocode(key)
+geocode_cache = GeocodeCache(geocoder)
 
 class CarController:
-    def __init__(self, db_driver, logger=None):
+    # point counts precomputed by build_lod()
+    LOD_LEVELS = (200, 1000, 5000)
+
+    def __init__(self, db_driver, logger=None, geocoder=None, geocoding_pool=None, lod_cache=False):
         if logger is None:
             self.__logger = logging.getLogger(__name__)
         else:
             self.__logger = logger
         self.__db_driver = db_driver
+        # geocoder: a GeocodeCache, or an OpenCageGeocode-like object wrapped in one
+        self.__geocoder = as_geocode_cache(geocoder)
+
+        # a pool created here is stopped by close()
+        self.__owns_geocoding_pool = geocoding_pool is None
+        if geocoding_pool is None:
+            geocoding_pool = GeocodingPool(geocode_cache if geocoder is None else self.__geocoder, db_driver,
+                                           logger=self.__logger)
+        self.geocoding_pool = geocoding_pool
+        # downsampled series of terminated sessions are stored and read back on the next request
+        self.lod_cache = lod_cache
+
+    def close(self, wait=True):
+        # stops the geocoding pool of the controller, once the pending addresses are resolved if wait
+        if not self.__owns_geocoding_pool:
+            return
+        if wait:
+            self.geocoding_pool.join()
+        self.geocoding_pool.stop()
 
-    def __uid_from_origin(self, origin):
+    def uid_from_origin(self, origin):
         return hashlib.md5(origin.encode('utf-8')).hexdigest()
 
     def create(self, origin):
-        session_uid = self.__uid_from_origin(origin)
+        session_uid = self.uid_from_origin(origin)
         self.__logger.info("Creating session {} from {}".format(session_uid, origin))
         self.__db_driver.create_session(session_uid, origin)
         return self.get(session_uid)
 
     def recreate(self, origin):
-        session_uid = self.__uid_from_origin(origin)
+        session_uid = self.uid_from_origin(origin)
         self.__logger.info("Re-creating session {} from {}".format(session_uid, origin))
-        self.__db_driver.delete_session(session_uid)
+        self.__db_driver.delete_session(session_uid, car_data=True)
         return self.create(origin)
 
     def get(self, session_uid):
@@ -37,25 +66,112 @@ class CarController:
         if mongo_dict is None:
             raise Exception("Session {} does not exist".format(session_uid))
 
-        session = CarSession(session_uid, db_driver=self.__db_driver, logger=self.__logger)
+        session = CarSession(session_uid, db_driver=self.__db_driver, logger=self.__logger,
+                             geocoder=self.__geocoder, geocoding_pool=self.geocoding_pool)
         session.fromDict(**mongo_dict)
 
         return session
 
-    def get_all(self):
-        mongo_dicts = self.__db_driver.get_all_sessions()
+    def get_all(self, status=None, start=None, end=None):
+        # every matching session as a lazy proxy, most recent first
         sessions = []
+        after = None
+        while True:
+            page, after = self.list_sessions(status=status, start=start, end=end, after=after, limit=500)
+            sessions.extend(page)
+            if after is None:
+                return sessions
+
+    def list_sessions(self, status=None, start=None, end=None, after=None, limit=50):
+        # one page of CarSessionProxy and the cursor of the next page, see CarDriver.list_sessions()
+        mongo_dicts, after = self.__db_driver.list_sessions(status=status, start=start, end=end,
+                                                            after=after, limit=limit)
+        return [ CarSessionProxy(self, mongo_dict) for mongo_dict in mongo_dicts ], after
+
+    def get_car_data(self, uid, offset=0, limit=None, compact=False):
+        car_datas = self.__db_driver.get_car_data(uid, offset, limit, compact=compact)
+        return car_datas
+
+    def iter_car_data(self, uid, after=None, fields=None, batch_size=1000):
+        return self.__db_driver.iter_car_data(uid, after=after, fields=fields, batch_size=batch_size)
+
+    def get_car_data_page(self, uid, after=None, limit=1000, fields=None):
+        # one page of samples and the cursor of the next page, see CarDriver.get_car_data_page()
+        return self.__db_driver.get_car_data_page(uid, after=after, limit=limit, fields=fields)
+
+    def get_track(self, uid, points=1000):
+        # GPS fixes simplified to about 'points' points keeping the shape of the track
+        def compute():
+            fixes = [ (d["timestamp"], d["latitude"], d["longitude"])
+                      for d in self.__db_driver.iter_car_data(uid, fields=("latitude", "longitude"), batch_size=5000)
+                      if d.get("latitude") and d.get("longitude") ]
+            return [ dict(timestamp=t, latitude=lat, longitude=lon) for t, lat, lon in simplify_track(fixes, points) ]
+
+        return self._level_of_detail(uid, "track:{}".format(points), compute)
+
+    def get_downsampled(self, uid, fields=SCALAR_FIELDS, points=1000):
+        # time buckets with the min/max/avg of each field, see CarDriver.downsample_car_data()
+        fields = tuple(fields)
+        return self._level_of_detail(uid, "series:{}:{}".format(",".join(fields), points),
+                                     lambda: self.__db_driver.downsample_car_data(uid, fields, points,
+                                                                                  CarSession.UNKNOWN_VALUES))
+
+    def _level_of_detail(self, uid, key, compute):
+        if not self.lod_cache:
+            return compute()
+
+        data = self.__db_driver.get_lod(uid, key)
+        if data is not None:
+            return data
+
+        data = compute()
+        autopial_session = self.__db_driver.get_session(uid)
+        # an ongoing session still receives samples, its levels would get stale
+        if autopial_session is not None and autopial_session.get("status") == CarSession.STATUS_TERMINATED:
+            self.__db_driver.save_lod(uid, key, data)
+        return data
+
+    def build_lod(self, uid, levels=None, fields=SCALAR_FIELDS):
+        levels = self.LOD_LEVELS if levels is None else levels
+        lod_cache = self.lod_cache
+        self.lod_cache = True
+        try:
+            for points in levels:
+                self.get_track(uid, points)
+                self.get_downsampled(uid, fields, points)
+        finally:
+            self.lod_cache = lod_cache
+
+class CarSessionProxy():
+    """Session of a listing: the listed fields are read from the listing document and any
+    other attribute loads the whole CarSession on first access."""
+
+    def __init__(self, controller, summary):
+        object.__setattr__(self, "_controller", controller)
+        object.__setattr__(self, "_summary", summary)
+        object.__setattr__(self, "_session", None)
+        object.__setattr__(self, "uid", summary[ "uid" ])
 
-        for mongo_dict in mongo_dicts:
-            session = CarSession(mongo_dict["uid"], db_driver=self.__db_driver, logger=self.__logger)
-            session.fromDict(**mongo_dict)
-            sessions.append(session)
+    @property
+    def session(self):
+        if self._session is None:
+            object.__setattr__(self, "_session", self._controller.get(self.uid))
+        return self._session
 
-        return sessions
+    def __getattr__(self, name):
+        # only called for attributes the proxy does not have itself
+        if name.startswith("_"):
+            raise AttributeError(name)
+        if self._session is None and name in self._summary:
+            return self._summary[ name ]
+        return getattr(self.session, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.session, name, value)
+
+    def __repr__(self):
+        return "<CarSessionProxy {} {}>".format(self.uid, "loaded" if self._session is not None else "summary")
 
-    def get_car_data(self, uid, offset=0, limit=None):
-        car_datas = self.__db_driver.get_car_data(uid, offset, limit)
-        return car_datas
 
 class CarSession:
     STATUS_NOTSTARTED = "NOT_STARTED"
@@ -65,13 +181,31 @@ class CarSession:
     DATA_VALID_FIELDS = dict(timestamp=-1.0, latitude=0.0, longitude=0.0, fix=False, altitude=-1.0, gps_speed=-1.0,
                              direction=-1.0, rpm=-1.0, obd_speed=-1.0, coolant_temp=-1.0, oil_temp=-1.0, accel_x=0.0,
                              accel_y=0.0, accel_z=0.0)
+    # defaults standing for "not measured", unlike the 0.0 of positions and accelerations
+    UNKNOWN_VALUES = { field: value for field, value in DATA_VALID_FIELDS.items() if value == -1.0 }
+
+    # session document fields written back by save() when modified
+    PERSISTED_FIELDS = ("origin", "status", "start_date", "start_point", "end_date", "end_point",
+                        "first_address", "last_address", "distance", "duration", "bbox", "statistics")
+
+    # running aggregates are written to the session every AGGREGATES_SAVE_INTERVAL samples
+    AGGREGATES_SAVE_INTERVAL = 100
+
+    def __init__(self, session_uid, db_driver, logger=None, geocoder=None, geocoding_pool=None):
+        self.__dirty = set()
 
-    def __init__(self, session_uid, db_driver, logger=None):
         if logger is None:
             self.__logger = logging.getLogger(__name__)
         else:
             self.__logger = logger
         self.__db_driver = db_driver
+        if geocoder is None:
+            self.__geocoder = geocode_cache
+        else:
+            self.__geocoder = as_geocode_cache(geocoder)
+        # without a pool, addresses are resolved synchronously
+        self.__geocoding_pool = geocoding_pool
+        self.__requested_addresses = set()
 
         self.uid = session_uid
 
@@ -88,20 +222,46 @@ class CarSession:
 
         self.distance = -1.0
         self.duration = -1.0
+        # [min_lat, min_lon, max_lat, max_lon] of the fixes, None until the first fix
+        self.bbox = None
 
         self.last_comm = None
-        self.car_datas = []
+        self.nbr_car_datas = 0
+
+        # SessionStatistics.to_dict() snapshot, refreshed when the session is saved
+        self.statistics = None
+        self.__statistics = SessionStatistics(logger=self.__logger)
 
         self.__prev_pos = (0.0, 0.0)
+        # origin is only known from the database, never overwrite it with the default
+        self.__dirty.discard("origin")
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name in self.PERSISTED_FIELDS:
+            self.__dirty.add(name)
 
     @property
     def nbr_events(self):
-        return len(self.car_datas)
+        return self.nbr_car_datas
+
+    @property
+    def dirty_fields(self):
+        return set(self.__dirty)
 
     def fromDict(self, **kwargs):
         for key in kwargs:
-            if hasattr(self, key):
+            if key == "statistics" and kwargs[key] is not None:
+                # resume the statistics where the stored session left them
+                self.__statistics = SessionStatistics.from_dict(kwargs[key], logger=self.__logger)
+                object.__setattr__(self, "statistics", kwargs[key])
+                self.__dirty.discard(key)
+            elif hasattr(self, key):
                 setattr(self, key, kwargs[key])
+                self.__dirty.discard(key)
+            elif key == "car_datas":
+                # session stored before the nbr_car_datas counter
+                self.nbr_car_datas = len(kwargs[key])
             elif key == "uid":
                 self.uid = kwargs[key]
             elif key == "_id":
@@ -114,94 +274,93 @@ class CarSession:
         self.start_date = start_date
 
         self.status = self.STATUS_ONGOING
-        kwargs = {
-            "start_date": self.start_date,
-            "start_point": self.start_point,
-            "first_address": self.first_address,
-            "end_point": self.end_point,
-            "last_address": self.last_address,
-            "duration": self.duration,
-            "distance": self.distance,
-            "end_date": self.end_date,
-            "status": self.status
-        }
-        self.__db_driver.update_session(self.uid, **kwargs)
+        self.save()
 
     def stop(self):
         self.__logger.info("Stopping session {}".format(self.uid))
+        self.flush()
         self._terminate_session()
         self.print_session()
 
     def _terminate_session(self):
-        car_datas = self.get_car_data()
-
-        first_data = car_datas[ 0 ]
-        last_data = car_datas[ -1 ]
+        if self.bbox is None:
+            # session recorded without running aggregates (or without any fix yet)
+            aggregates = self.__db_driver.compute_session_aggregates(self.uid)
+            if aggregates is not None:
+                self.start_point = aggregates[ "start_point" ]
+                self.end_point = aggregates[ "end_point" ]
+                self.duration = aggregates[ "duration" ]
+                self.distance = aggregates[ "distance" ]
+                self.bbox = aggregates[ "bbox" ]
+
+        if self.duration >= 0:
+            self.end_date = self.start_date + datetime.timedelta(seconds=self.duration)
+
+        max_distance = 0.0
+        if self.bbox is not None:
+            min_lat, min_lon, max_lat, max_lon = self.bbox
+            max_distance = haversine((min_lat, min_lon), (max_lat, max_lon))
 
-        self.start_point = (first_data[ "latitude" ], first_data[ "longitude" ])
-        self.end_point = (last_data[ "latitude" ], last_data[ "longitude" ])
-
-        self.duration = last_data[ "timestamp" ]
-        self.distance = last_data[ "distance" ]
-
-        self.end_date = self.start_date + datetime.timedelta(seconds=self.duration)
-
-        min_lat = min_lon = 9999
-        max_lat = max_lon = -9999
-        for t in reversed(car_datas):
-            if t[ "latitude" ]:
-                if t[ "latitude" ] > max_lat:
-                    max_lat = t[ "latitude" ]
-                if t[ "latitude" ] < min_lat:
-                    min_lat = t[ "latitude" ]
-
-            if t[ "longitude" ]:
-                if t[ "longitude" ] > max_lon:
-                    max_lon = t[ "longitude" ]
-                if t[ "longitude" ] < min_lon:
-                    min_lon = t[ "longitude" ]
-
-            if t[ "latitude" ] and t[ "longitude" ] and self.last_address is None:
-                self.last_address = self.address(t[ "latitude" ], t[ "longitude" ])
-
-        max_distance = haversine((min_lat, min_lon), (max_lat, max_lon))
         if max_distance < 1:
             self.__logger.warning(
                 "Deleting session with too small geographical dilution ({} km)".format(round(max_distance, 3)))
             self.__db_driver.delete_session(self.uid)
             return
 
+        if self.last_address is None:
+            self.request_address("last_address", *self.end_point)
+
         self.status = self.STATUS_TERMINATED
-        kwargs = {
-            "start_point": self.start_point,
-            "first_address": self.first_address,
-            "end_point": self.end_point,
-            "last_address": self.last_address,
-            "duration": self.duration,
-            "distance": self.distance,
-            "end_date": self.end_date,
-            "status": self.status
-        }
-
-        self.__db_driver.update_session(self.uid, **kwargs)
+        if self.__statistics.nbr_samples:
+            self.statistics = self.__statistics.to_dict()
+        self.save()
+
+    def save(self):
+        if not self.__dirty:
+            return 0
+
+        kwargs = {field: getattr(self, field) for field in self.__dirty}
+        self.__dirty.clear()
+        return self.__db_driver.update_session(self.uid, **kwargs)
+
+    def request_address(self, field, latitude, longitude):
+        # a field is only marked while its lookup is queued or once resolved, a dropped or
+        # unresolved lookup is retried on the next call
+        if field in self.__requested_addresses:
+            return
+
+        if self.__geocoding_pool is None:
+            address = self.address(latitude, longitude)
+            if address is not None:
+                self.__requested_addresses.add(field)
+                setattr(self, field, address)
+            return
+
+        # the pool patches the session document itself, save() must not overwrite it
+        self.__dirty.discard(field)
+        self.__requested_addresses.add(field)
+        if not self.__geocoding_pool.submit(self.uid, field, latitude, longitude, callback=self._address_resolved):
+            self.__requested_addresses.discard(field)
+
+    def _address_resolved(self, field, address):
+        if address is None:
+            self.__requested_addresses.discard(field)
+            return
+        object.__setattr__(self, field, address)
 
     def address(self, latitude, longitude):
         try:
-            results = geocoder.reverse_geocode(latitude, longitude, language='fr', no_annotation='1')
-            if results and len(results):
-                return results[ 0 ][ 'formatted' ]
+            with metrics.timer("geocoding.address"):
+                return self.__geocoder.address(latitude, longitude)
         except RateLimitExceededError as ex:
+            metrics.count("geocoding.rate_limited")
             self.__logger.warning("OpenCageData rate limit exceeded !")
             return "<Limit reached, try later>"
 
     def new_car_data(self, latitude, longitude, **kwargs):
-        valid_dict = dict()
-
-        for field in self.DATA_VALID_FIELDS:
-            if field in kwargs:
-                valid_dict[ field ] = kwargs[ field ]
-            else:
-                valid_dict[ field ] = self.DATA_VALID_FIELDS[ field ]
+        valid_dict = self.DATA_VALID_FIELDS.copy()
+        for field in kwargs.keys() & valid_dict.keys():
+            valid_dict[ field ] = kwargs[ field ]
 
         valid_dict[ "latitude" ] = latitude
         valid_dict[ "longitude" ] = longitude
@@ -210,10 +369,22 @@ class CarSession:
             self.distance += haversine(self.__prev_pos, (latitude, longitude))
 
         if self.first_address is None and latitude != 0 and longitude != 0:
-            self.first_address = self.address(latitude, longitude)
+            self.request_address("first_address", latitude, longitude)
 
         self.__prev_pos = (latitude, longitude)
 
+        if latitude and longitude:
+            if self.bbox is None:
+                self.start_point = (latitude, longitude)
+                self.bbox = [ latitude, longitude, latitude, longitude ]
+            else:
+                min_lat, min_lon, max_lat, max_lon = self.bbox
+                if latitude < min_lat or longitude < min_lon or latitude > max_lat or longitude > max_lon:
+                    self.bbox = [ min(min_lat, latitude), min(min_lon, longitude),
+                                  max(max_lat, latitude), max(max_lon, longitude) ]
+            self.end_point = (latitude, longitude)
+        self.duration = valid_dict[ "timestamp" ]
+
         if latitude != 0.0 and longitude != 0.0 and "fix" not in valid_dict:
             valid_dict[ "fix" ] = True
         else:
@@ -223,9 +394,18 @@ class CarSession:
         valid_dict[ "distance" ] = self.distance
         # print (valid_dict)
         self.__db_driver.add_car_data(**valid_dict)
+        self.nbr_car_datas += 1
+        self.__statistics.update(valid_dict)
+
+        if self.nbr_car_datas % self.AGGREGATES_SAVE_INTERVAL == 0:
+            self.statistics = self.__statistics.to_dict()
+            self.save()
+
+    def flush(self):
+        return self.__db_driver.flush()
 
-    def get_car_data(self):
-        car_datas = self.__db_driver.get_car_data(self.uid)
+    def get_car_data(self, compact=False):
+        car_datas = self.__db_driver.get_car_data(self.uid, compact=compact)
         return car_datas
 
     def print_session(self):
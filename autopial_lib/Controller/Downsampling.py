@@ -0,0 +1,54 @@
+import heapq
+import math
+
+# scalar channels downsampled by time buckets
+SCALAR_FIELDS = ("gps_speed", "obd_speed", "rpm", "coolant_temp", "oil_temp", "altitude")
+
+
+def simplify_track(points, target):
+    """Visvalingam-Whyatt simplification of a GPS track down to 'target' points.
+
+    points are (timestamp, latitude, longitude) tuples in time order. The point forming
+    the smallest triangle with its neighbours is removed first, so straight lines collapse
+    while turns are kept. The first and the last points are always kept.
+    """
+    n = len(points)
+    if n <= max(target, 2):
+        return list(points)
+
+    # equirectangular projection around the track, good enough to compare triangle areas
+    scale = math.cos(math.radians(sum(p[ 1 ] for p in points) / n))
+    xs = [ p[ 2 ] * scale for p in points ]
+    ys = [ p[ 1 ] for p in points ]
+    preceding = list(range(-1, n - 1))
+    following = list(range(1, n + 1))
+
+    def area(i):
+        p, q = preceding[ i ], following[ i ]
+        return abs((xs[ p ] - xs[ i ]) * (ys[ q ] - ys[ i ]) - (xs[ q ] - xs[ i ]) * (ys[ p ] - ys[ i ])) / 2
+
+    areas = [ math.inf ] * n
+    for i in range(1, n - 1):
+        areas[ i ] = area(i)
+    heap = [ (areas[ i ], i) for i in range(1, n - 1) ]
+    heapq.heapify(heap)
+
+    removed = [ False ] * n
+    remaining = n
+    while remaining > max(target, 2) and heap:
+        a, i = heapq.heappop(heap)
+        if removed[ i ] or a != areas[ i ]:
+            # stale entry, the area of i changed when one of its neighbours was removed
+            continue
+        removed[ i ] = True
+        remaining -= 1
+        p, q = preceding[ i ], following[ i ]
+        following[ p ] = q
+        preceding[ q ] = p
+        for j in (p, q):
+            if 0 < j < n - 1:
+                # a point never becomes less significant than the ones already removed around it
+                areas[ j ] = max(area(j), a)
+                heapq.heappush(heap, (areas[ j ], j))
+
+    return [ points[ i ] for i in range(n) if not removed[ i ] ]
@@ -0,0 +1,169 @@
+import datetime
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import pymongo
+
+from autopial_lib.metrics import metrics
+
+
+class GeocodeCache():
+    """Reverse geocoding through any object with an OpenCage-like reverse_geocode(),
+    cached on coordinates rounded to 'precision' decimals (4 decimals ~ 11 meters).
+
+    Lookups go to an in-memory LRU first, then to the optional persistent store.
+    """
+
+    def __init__(self, geocoder, store=None, precision=4, max_entries=4096, ttl=None, language='fr', logger=None):
+        if logger is None:
+            self.logger = logging.getLogger(__name__)
+        else:
+            self.logger = logger
+
+        self.geocoder = geocoder
+        self.store = store
+        self.precision = precision
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.language = language
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, latitude, longitude):
+        return "{:.{p}f},{:.{p}f}".format(latitude, longitude, p=self.precision)
+
+    def _is_valid(self, created):
+        if self.ttl is None:
+            return True
+        return (datetime.datetime.now() - created).total_seconds() < self.ttl
+
+    def _remember(self, key, address, created):
+        with self._lock:
+            self._entries[ key ] = (address, created)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def cached(self, latitude, longitude):
+        # returns (True, address) when the coordinates are already known, (False, None) otherwise
+        key = self.key(latitude, longitude)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self._is_valid(entry[ 1 ]):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    metrics.count("geocoding.cache_hits")
+                    return True, entry[ 0 ]
+                del self._entries[ key ]
+
+        if self.store is not None:
+            entry = self.store.get(key)
+            if entry is not None and self._is_valid(entry[ 1 ]):
+                self._remember(key, *entry)
+                self.hits += 1
+                metrics.count("geocoding.cache_hits")
+                return True, entry[ 0 ]
+        return False, None
+
+    def address(self, latitude, longitude):
+        found, address = self.cached(latitude, longitude)
+        if found:
+            return address
+
+        self.misses += 1
+        metrics.count("geocoding.cache_misses")
+        with metrics.timer("geocoding.reverse_geocode"):
+            results = self.geocoder.reverse_geocode(latitude, longitude, language=self.language, no_annotation='1')
+        address = None
+        if results and len(results):
+            address = results[ 0 ][ 'formatted' ]
+
+        key = self.key(latitude, longitude)
+        created = datetime.datetime.now()
+        self._remember(key, address, created)
+        if self.store is not None:
+            self.store.set(key, address, created)
+        self.logger.debug("Geocoded {} = '{}'".format(key, address))
+        return address
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def as_geocode_cache(geocoder):
+    # GeocodeCache-like objects (cached() and address()) as is, raw geocoders wrapped in a GeocodeCache
+    if geocoder is None or (hasattr(geocoder, "cached") and hasattr(geocoder, "address")):
+        return geocoder
+    return GeocodeCache(geocoder)
+
+
+class MongoGeocodeStore():
+    COLLECTION = "geocode_cache"
+
+    def __init__(self, database, ttl=None):
+        self.collection = database[ self.COLLECTION ]
+        if ttl is not None:
+            self.collection.create_index([("created", pymongo.ASCENDING)], name="created", expireAfterSeconds=ttl)
+
+    def get(self, key):
+        entry = self.collection.find_one({"_id": key})
+        if entry is None:
+            return None
+        return entry[ "address" ], entry[ "created" ]
+
+    def set(self, key, address, created):
+        self.collection.update_one({"_id": key}, {'$set': {"address": address, "created": created}}, upsert=True)
+
+
+class FileGeocodeStore():
+    DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+    def __init__(self, filepath, logger=None):
+        if logger is None:
+            self.logger = logging.getLogger(__name__)
+        else:
+            self.logger = logger
+
+        self.filepath = filepath
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.exists(filepath):
+            try:
+                with open(filepath, 'r') as f:
+                    self._entries = json.load(f)
+            except ValueError as e:
+                self.logger.warning("Ignoring corrupted geocode cache '{}': {}".format(filepath, e))
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        return entry[ 0 ], datetime.datetime.strptime(entry[ 1 ], self.DATE_FORMAT)
+
+    def set(self, key, address, created):
+        with self._lock:
+            self._entries[ key ] = (address, created.strftime(self.DATE_FORMAT))
+            tmp_filepath = self.filepath + ".tmp"
+            with open(tmp_filepath, 'w') as f:
+                json.dump(self._entries, f)
+            os.replace(tmp_filepath, self.filepath)
+
+
+class OfflineGeocoder():
+    """Network-free stand-in for OpenCageGeocode, answering with the coordinates themselves."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def reverse_geocode(self, latitude, longitude, **kwargs):
+        self.calls += 1
+        return [ {'formatted': "{:.5f}, {:.5f}".format(latitude, longitude)} ]
@@ -0,0 +1,114 @@
+import logging
+import queue
+import threading
+import time
+
+from opencage.geocoder import RateLimitExceededError
+
+
+class GeocodingPool():
+    """Background reverse geocoding of session addresses.
+
+    Requests go to a bounded queue served by worker threads sharing a token bucket of
+    'rate' requests per second. Once resolved, the address is written to the session
+    document and handed to the optional callback, which gets None when the lookup was
+    rate limited or found nothing.
+    """
+
+    def __init__(self, geocoder, db_driver, workers=2, queue_size=256, rate=1.0, logger=None):
+        if logger is None:
+            self.logger = logging.getLogger(__name__)
+        else:
+            self.logger = logger
+
+        self.geocoder = geocoder
+        self.db_driver = db_driver
+        self.rate = rate
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._tokens = 1.0
+        self._tokens_date = time.monotonic()
+        self._tokens_lock = threading.Lock()
+        self._stopevent = threading.Event()
+
+        self.dropped = 0
+        self.resolved = 0
+
+        self._workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self._run, name="geocoding-{}".format(i))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def submit(self, session_uid, field, latitude, longitude, callback=None):
+        try:
+            self._queue.put_nowait((session_uid, field, latitude, longitude, callback))
+        except queue.Full:
+            self.dropped += 1
+            self.logger.warning("Geocoding queue full, dropping {} of session {}".format(field, session_uid))
+            return False
+        return True
+
+    def _acquire(self):
+        while not self._stopevent.is_set():
+            with self._tokens_lock:
+                now = time.monotonic()
+                self._tokens = min(1.0, self._tokens + (now - self._tokens_date) * self.rate)
+                self._tokens_date = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return True
+                delay = (1.0 - self._tokens) / self.rate
+            self._stopevent.wait(delay)
+        return False
+
+    def _run(self):
+        while not self._stopevent.is_set():
+            try:
+                session_uid, field, latitude, longitude, callback = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+            address = None
+            try:
+                address = self._resolve(latitude, longitude)
+                if address is not None:
+                    self.db_driver.update_session(session_uid, **{field: address})
+                    self.resolved += 1
+            except Exception as e:
+                self.logger.error("Geocoding {} of session {} failed: {}".format(field, session_uid, e))
+                address = None
+
+            try:
+                if callback is not None:
+                    callback(field, address)
+            except Exception as e:
+                self.logger.error("Geocoding callback of session {} failed: {}".format(session_uid, e))
+            finally:
+                self._queue.task_done()
+
+    def _resolve(self, latitude, longitude):
+        found, address = self.geocoder.cached(latitude, longitude)
+        if found:
+            return address
+
+        if not self._acquire():
+            return None
+        try:
+            return self.geocoder.address(latitude, longitude)
+        except RateLimitExceededError:
+            self.logger.warning("OpenCageData rate limit exceeded !")
+            return None
+
+    def join(self):
+        self._queue.join()
+
+    def stop(self):
+        self._stopevent.set()
+        for worker in self._workers:
+            worker.join()
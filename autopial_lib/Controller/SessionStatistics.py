@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import logging
+import math
+
+# fields read by update(), for rebuilds from the stored car data
+STATISTICS_FIELDS = ("timestamp", "obd_speed", "gps_speed", "rpm", "coolant_temp", "accel_x", "accel_y")
+
+
+class SessionStatistics():
+    """Session statistics updated sample by sample, stored as the 'statistics' session field.
+
+    Speeds are in km/h (OBD speed when known, GPS speed otherwise), the rpm histogram
+    counts samples per 'rpm_bin' wide bins, coolant_hot_time is the time (seconds) spent
+    above 'coolant_threshold' (°C) and harsh_events counts the times the horizontal
+    acceleration (accel_x/accel_y, in g) went above 'harsh_threshold'.
+    Unknown values (negative speeds or rpm, missing accelerations) are ignored.
+    """
+
+    def __init__(self, coolant_threshold=105.0, harsh_threshold=0.35, rpm_bin=500, logger=None):
+        if logger is None:
+            self.logger = logging.getLogger(__name__)
+        else:
+            self.logger = logger
+
+        self.coolant_threshold = coolant_threshold
+        self.harsh_threshold = harsh_threshold
+        self.rpm_bin = rpm_bin
+
+        self.nbr_samples = 0
+        self.speed_count = 0
+        self.speed_sum = 0.0
+        self.max_speed = 0.0
+        self.max_rpm = 0.0
+        self.rpm_histogram = {}
+        self.coolant_hot_time = 0.0
+        self.max_coolant_temp = None
+        self.harsh_events = 0
+        self.max_g = 0.0
+
+        self._last_timestamp = None
+        self._coolant_hot = False
+        self._harsh = False
+
+    def update(self, car_data):
+        self.nbr_samples += 1
+        timestamp = car_data.get("timestamp")
+
+        speed = car_data.get("obd_speed")
+        if speed is None or speed < 0:
+            speed = car_data.get("gps_speed")
+        if speed is not None and speed >= 0:
+            self.speed_count += 1
+            self.speed_sum += speed
+            if speed > self.max_speed:
+                self.max_speed = speed
+
+        rpm = car_data.get("rpm")
+        if rpm is not None and rpm >= 0:
+            if rpm > self.max_rpm:
+                self.max_rpm = rpm
+            # Mongo document keys must be strings
+            rpm_bin = str(int(rpm // self.rpm_bin) * self.rpm_bin)
+            self.rpm_histogram[ rpm_bin ] = self.rpm_histogram.get(rpm_bin, 0) + 1
+
+        # the time between two samples is attributed to the state of the first one
+        if self._coolant_hot and timestamp is not None and self._last_timestamp is not None:
+            self.coolant_hot_time += max(0.0, timestamp - self._last_timestamp)
+        coolant_temp = car_data.get("coolant_temp")
+        if coolant_temp is not None and coolant_temp >= 0:
+            self._coolant_hot = coolant_temp > self.coolant_threshold
+            if self.max_coolant_temp is None or coolant_temp > self.max_coolant_temp:
+                self.max_coolant_temp = coolant_temp
+
+        accel_x = car_data.get("accel_x")
+        accel_y = car_data.get("accel_y")
+        if accel_x is not None and accel_y is not None and not (math.isnan(accel_x) or math.isnan(accel_y)):
+            g = math.hypot(accel_x, accel_y)
+            if g > self.max_g:
+                self.max_g = g
+            harsh = g > self.harsh_threshold
+            if harsh and not self._harsh:
+                self.harsh_events += 1
+            self._harsh = harsh
+
+        if timestamp is not None:
+            self._last_timestamp = timestamp
+
+    @property
+    def avg_speed(self):
+        return self.speed_sum / self.speed_count if self.speed_count else 0.0
+
+    def to_dict(self):
+        return dict(nbr_samples=self.nbr_samples,
+                    avg_speed=self.avg_speed,
+                    max_speed=self.max_speed,
+                    max_rpm=self.max_rpm,
+                    rpm_histogram=dict(self.rpm_histogram),
+                    rpm_bin=self.rpm_bin,
+                    coolant_threshold=self.coolant_threshold,
+                    coolant_hot_time=self.coolant_hot_time,
+                    max_coolant_temp=self.max_coolant_temp,
+                    harsh_threshold=self.harsh_threshold,
+                    harsh_events=self.harsh_events,
+                    max_g=self.max_g,
+                    # state needed to resume the statistics of a session loaded from the database
+                    state=dict(speed_count=self.speed_count, speed_sum=self.speed_sum,
+                               last_timestamp=self._last_timestamp,
+                               coolant_hot=self._coolant_hot, harsh=self._harsh))
+
+    @classmethod
+    def from_dict(cls, statistics, logger=None):
+        self = cls(coolant_threshold=statistics.get("coolant_threshold", 105.0),
+                   harsh_threshold=statistics.get("harsh_threshold", 0.35),
+                   rpm_bin=statistics.get("rpm_bin", 500),
+                   logger=logger)
+        self.nbr_samples = statistics.get("nbr_samples", 0)
+        self.max_speed = statistics.get("max_speed", 0.0)
+        self.max_rpm = statistics.get("max_rpm", 0.0)
+        self.rpm_histogram = dict(statistics.get("rpm_histogram", {}))
+        self.coolant_hot_time = statistics.get("coolant_hot_time", 0.0)
+        self.max_coolant_temp = statistics.get("max_coolant_temp")
+        self.harsh_events = statistics.get("harsh_events", 0)
+        self.max_g = statistics.get("max_g", 0.0)
+
+        state = statistics.get("state", {})
+        self.speed_count = state.get("speed_count", 0)
+        self.speed_sum = state.get("speed_sum", 0.0)
+        self._last_timestamp = state.get("last_timestamp")
+        self._coolant_hot = state.get("coolant_hot", False)
+        self._harsh = state.get("harsh", False)
+        return self
+
+    @classmethod
+    def rebuild(cls, db_driver, uid, batch_size=5000, **kwargs):
+        # statistics of a session recorded before they were maintained, written to the session
+        statistics = cls(**kwargs)
+        for car_data in db_driver.iter_car_data(uid, fields=STATISTICS_FIELDS, batch_size=batch_size):
+            statistics.update(car_data)
+        db_driver.update_session(uid, statistics=statistics.to_dict())
+        statistics.logger.info("Session {} statistics rebuilt from {} samples".format(uid, statistics.nbr_samples))
+        return statistics
+
+
+if __name__ == '__main__':
+    from autopial_lib.MongoDatabaseDriver.CarDriver import CarDriver
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Rebuild the statistics stored on car sessions")
+    parser.add_argument("--db-path", default="mongodb://localhost:27017/")
+    parser.add_argument("--db-name", default="autopial-cardb")
+    parser.add_argument("--storage", default="document", choices=("document", "bucket"))
+    parser.add_argument("--coolant-threshold", type=float, default=105.0, help="coolant temperature in °C")
+    parser.add_argument("--harsh-threshold", type=float, default=0.35, help="horizontal acceleration in g")
+    parser.add_argument("uid", nargs="*", help="session uids, all sessions when omitted")
+    args = parser.parse_args()
+
+    driver = CarDriver(args.db_path, args.db_name, storage=args.storage)
+    uids = args.uid or [ autopial_session[ "uid" ] for autopial_session in driver.get_all_sessions() ]
+    for uid in uids:
+        SessionStatistics.rebuild(driver, uid, coolant_threshold=args.coolant_threshold,
+                                  harsh_threshold=args.harsh_threshold)
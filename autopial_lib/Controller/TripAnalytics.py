@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import logging
+
+import numpy as np
+
+from autopial_lib.car_samples import CAR_DATA_FIELDS, CarSamples
+
+# same mean earth radius as haversine()
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_array(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    d = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(d))
+
+
+def _stats(values):
+    if values.size == 0:
+        return dict(min=None, max=None, mean=None, p95=None)
+    return dict(min=float(values.min()),
+                max=float(values.max()),
+                mean=float(values.mean()),
+                p95=float(np.percentile(values, 95)))
+
+
+class TripAnalytics():
+    """Batched trip computations over the car data of a session loaded as column arrays.
+
+    max_speed (km/h) is the implied speed above which an isolated fix is considered a GPS jump,
+    idle_speed (km/h) the speed under which the car is considered idle.
+    """
+
+    def __init__(self, db_driver, logger=None, max_speed=250.0, idle_speed=2.0, batch_size=5000):
+        if logger is None:
+            self.logger = logging.getLogger(__name__)
+        else:
+            self.logger = logger
+        self.db_driver = db_driver
+        self.max_speed = max_speed
+        self.idle_speed = idle_speed
+        self.batch_size = batch_size
+
+    def load(self, uid, fields=CAR_DATA_FIELDS):
+        samples = CarSamples.from_rows(self.db_driver.iter_car_data(uid, fields=fields, batch_size=self.batch_size),
+                                       fields=fields)
+        # the arrays expose the buffer protocol: one copy per column, no per-value conversion
+        return { f: np.array(samples.column(f), dtype=np.float64) for f in fields }
+
+    def gps_jumps(self, timestamp, latitude, longitude):
+        # a fix is a jump when reaching it and leaving it both require more than max_speed
+        jumps = np.zeros(latitude.size, dtype=bool)
+        if latitude.size < 3:
+            return jumps
+
+        dt = np.diff(timestamp) / 3600.0
+        distance = haversine_array(latitude[ :-1 ], longitude[ :-1 ], latitude[ 1: ], longitude[ 1: ])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            speed = np.where(dt > 0, distance / dt, np.inf)
+        too_fast = speed > self.max_speed
+        jumps[ 1:-1 ] = too_fast[ :-1 ] & too_fast[ 1: ]
+        return jumps
+
+    def analyse(self, columns):
+        timestamp = columns[ "timestamp" ]
+        latitude = columns[ "latitude" ]
+        longitude = columns[ "longitude" ]
+        nbr_samples = timestamp.size
+
+        summary = dict(nbr_car_datas=int(nbr_samples), distance=0.0, duration=-1.0, bbox=None,
+                       start_point=(0, 0), end_point=(0, 0), idle_time=0.0, gps_jumps=0)
+        cumulative_distance = np.zeros(nbr_samples, dtype=np.float64)
+        if nbr_samples == 0:
+            return summary, cumulative_distance
+
+        summary[ "duration" ] = float(timestamp[ -1 ])
+
+        fix_index = np.flatnonzero((latitude != 0) & (longitude != 0) &
+                                   ~np.isnan(latitude) & ~np.isnan(longitude))
+        jumps = self.gps_jumps(timestamp[ fix_index ], latitude[ fix_index ], longitude[ fix_index ])
+        summary[ "gps_jumps" ] = int(jumps.sum())
+        fix_index = fix_index[ ~jumps ]
+
+        if fix_index.size:
+            fix_lat = latitude[ fix_index ]
+            fix_lon = longitude[ fix_index ]
+            segments = haversine_array(fix_lat[ :-1 ], fix_lon[ :-1 ], fix_lat[ 1: ], fix_lon[ 1: ])
+            cumulative_distance[ fix_index[ 1: ] ] = np.cumsum(segments)
+            # samples without a valid fix keep the distance reached so far
+            cumulative_distance = np.maximum.accumulate(cumulative_distance)
+
+            summary.update(distance=float(cumulative_distance[ -1 ]),
+                           bbox=[ float(fix_lat.min()), float(fix_lon.min()),
+                                  float(fix_lat.max()), float(fix_lon.max()) ],
+                           start_point=(float(fix_lat[ 0 ]), float(fix_lon[ 0 ])),
+                           end_point=(float(fix_lat[ -1 ]), float(fix_lon[ -1 ])))
+
+        # OBD speed when the car reports it, GPS speed otherwise; -1 means unknown
+        speed = columns.get("obd_speed")
+        if speed is None or not np.any(speed >= 0):
+            speed = columns.get("gps_speed")
+        if speed is not None:
+            known = speed >= 0
+            summary[ "speed" ] = _stats(speed[ known ])
+
+            dt = np.diff(timestamp)
+            moving = (dt > 0) & known[ 1: ] & known[ :-1 ]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                # km/h per second to m/s2
+                acceleration = np.diff(speed)[ moving ] / dt[ moving ] / 3.6
+            summary[ "acceleration" ] = _stats(acceleration)
+            summary[ "idle_time" ] = float(dt[ (speed[ :-1 ] < self.idle_speed) & known[ :-1 ] ].sum())
+
+        if "accel_x" in columns and "accel_y" in columns:
+            g_force = np.hypot(columns[ "accel_x" ], columns[ "accel_y" ])
+            summary[ "g_force" ] = _stats(g_force[ ~np.isnan(g_force) ])
+
+        return summary, cumulative_distance
+
+    def analyse_session(self, uid):
+        return self.analyse(self.load(uid))
+
+    def backfill(self, uid):
+        columns = self.load(uid)
+        summary, cumulative_distance = self.analyse(columns)
+        if columns[ "timestamp" ].size == 0:
+            self.logger.warning("Session {} has no car data, nothing to backfill".format(uid))
+            return summary
+
+        self.db_driver.update_car_data_field(uid, "distance", columns[ "timestamp" ].tolist(),
+                                             cumulative_distance.tolist())
+        self.db_driver.update_session(uid,
+                                      distance=summary[ "distance" ],
+                                      duration=summary[ "duration" ],
+                                      bbox=summary[ "bbox" ],
+                                      start_point=summary[ "start_point" ],
+                                      end_point=summary[ "end_point" ])
+        self.logger.info("Session {} backfilled: {} samples, {} km, {} GPS jump(s) filtered".format(
+            uid, summary[ "nbr_car_datas" ], round(summary[ "distance" ], 3), summary[ "gps_jumps" ]))
+        return summary
+
+    def backfill_all(self):
+        summaries = {}
+        for autopial_session in self.db_driver.get_all_sessions():
+            summaries[ autopial_session[ "uid" ] ] = self.backfill(autopial_session[ "uid" ])
+        return summaries
+
+
+if __name__ == '__main__':
+    from autopial_lib.MongoDatabaseDriver.CarDriver import CarDriver
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Recompute car data distances and session summaries")
+    parser.add_argument("--db-path", default="mongodb://localhost:27017/")
+    parser.add_argument("--db-name", default="autopial-cardb")
+    parser.add_argument("--storage", default="document", choices=("document", "bucket"))
+    parser.add_argument("--max-speed", type=float, default=250.0, help="GPS jump threshold in km/h")
+    parser.add_argument("uid", nargs="*", help="session uids, all sessions when omitted")
+    args = parser.parse_args()
+
+    analytics = TripAnalytics(CarDriver(args.db_path, args.db_name, storage=args.storage), max_speed=args.max_speed)
+    if args.uid:
+        for uid in args.uid:
+            analytics.backfill(uid)
+    else:
+        analytics.backfill_all()
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import logging
+from collections import OrderedDict
+
+from pymongo import ASCENDING, UpdateMany
+
+from autopial_lib.car_samples import CAR_DATA_FIELDS
+
+# field projections for iter_car_data()
+GPS_FIELDS = ("timestamp", "fix", "latitude", "longitude", "altitude", "gps_speed", "direction")
+ENGINE_FIELDS = ("timestamp", "obd_speed", "rpm", "coolant_temp", "oil_temp")
+
+
+class DocumentStorage():
+    """One Mongo document per car data sample (historical layout)."""
+    COLLECTION = "car_data"
+    INDEXES = [
+        # _id breaks the ties between samples of the same timestamp, see page()
+        ([("session_uid", ASCENDING), ("timestamp", ASCENDING), ("_id", ASCENDING)], {"name": "session_uid_timestamp_id"})
+    ]
+
+    def __init__(self, database, logger=None, write_concern=None):
+        if logger is None:
+            self.logger = logging.getLogger(__name__)
+        else:
+            self.logger = logger
+        self.collection = database.get_collection(self.COLLECTION, write_concern=write_concern)
+
+    def insert(self, car_data):
+        return self.collection.insert_one(car_data).inserted_id
+
+    def insert_many(self, car_datas):
+        return self.collection.insert_many(car_datas, ordered=True).inserted_ids
+
+    def find(self, uid, offset=None, limit=None):
+        mongo_objects = self.collection\
+            .find({"session_uid": uid}, {'_id': False}) \
+            .sort("timestamp", 1)
+
+        if offset is not None:
+            mongo_objects.skip(offset)
+        if limit is not None:
+            mongo_objects.limit(limit)
+
+        return list(mongo_objects)
+
+    def iter(self, uid, after=None, fields=None, batch_size=1000, limit=None):
+        query = {"session_uid": uid}
+        if after is not None:
+            query["timestamp"] = {'$gt': after}
+
+        projection = {'_id': False}
+        if fields is not None:
+            projection.update({f: True for f in fields})
+            projection["timestamp"] = True
+            projection["session_uid"] = True
+
+        mongo_objects = self.collection\
+            .find(query, projection) \
+            .sort("timestamp", 1) \
+            .batch_size(batch_size)
+        if limit is not None:
+            mongo_objects.limit(limit)
+
+        for car_data in mongo_objects:
+            yield car_data
+
+    def page(self, uid, after=None, fields=None, limit=1000):
+        # (car datas, cursor of the next page or None), keyset paginated on (timestamp, _id)
+        query = {"session_uid": uid}
+        if after is not None:
+            after_timestamp, after_id = after
+            query['$or'] = [ {"timestamp": {'$gt': after_timestamp}},
+                             {"timestamp": after_timestamp, "_id": {'$gt': after_id}} ]
+
+        projection = None
+        if fields is not None:
+            projection = {f: True for f in fields}
+            projection.update(timestamp=True, session_uid=True)
+
+        car_datas = list(self.collection
+                         .find(query, projection)
+                         .sort([ ("timestamp", ASCENDING), ("_id", ASCENDING) ])
+                         .limit(limit))
+        after = (car_datas[ -1 ][ "timestamp" ], car_datas[ -1 ][ "_id" ]) if len(car_datas) == limit else None
+        for car_data in car_datas:
+            del car_data[ "_id" ]
+        return car_datas, after
+
+    def update_field(self, uid, field, timestamps, values, chunk_size=1000):
+        requests = [ UpdateMany({"session_uid": uid, "timestamp": t}, {'$set': {field: v}})
+                     for t, v in zip(timestamps, values) ]
+        for i in range(0, len(requests), chunk_size):
+            self.collection.bulk_write(requests[ i:i + chunk_size ], ordered=False)
+        return len(requests)
+
+    def delete(self, uid):
+        return self.collection.delete_many({"session_uid": uid}).deleted_count
+
+    def session_uids(self):
+        return self.collection.distinct("session_uid")
+
+    def sample_pipeline(self, uid, fields):
+        # aggregation stages producing one flat {field: value} document per sample
+        return [
+            {'$match': {"session_uid": uid}},
+            {'$project': dict({f: True for f in fields}, _id=False)}
+        ]
+
+    def queries(self, uid):
+        # (name, cursor) of the queries issued by find(), for CarDriver.explain_queries()
+        return [
+            ("get_car_data", self.collection.find({"session_uid": uid}, {'_id': False}).sort("timestamp", 1))
+        ]
+
+
+class BucketStorage():
+    """Car data samples packed by session into bucket documents of columnar arrays:
+
+        {session_uid, count, min_timestamp, max_timestamp, fields: {timestamp: [...], latitude: [...], ...}}
+    """
+    COLLECTION = "car_data_bucket"
+    INDEXES = [
+        ([("session_uid", ASCENDING), ("min_timestamp", ASCENDING), ("_id", ASCENDING)],
+         {"name": "session_uid_min_timestamp_id"})
+    ]
+
+    def __init__(self, database, logger=None, bucket_size=1000, write_concern=None):
+        if logger is None:
+            self.logger = logging.getLogger(__name__)
+        else:
+            self.logger = logger
+        self.collection = database.get_collection(self.COLLECTION, write_concern=write_concern)
+        self.bucket_size = bucket_size
+
+    def _new_bucket(self, uid, car_datas):
+        timestamps = [ d["timestamp"] for d in car_datas ]
+        return dict(session_uid=uid,
+                    count=len(car_datas),
+                    min_timestamp=min(timestamps),
+                    max_timestamp=max(timestamps),
+                    fields={ f: [ d[ f ] for d in car_datas ] for f in CAR_DATA_FIELDS })
+
+    def _push_update(self, car_datas):
+        timestamps = [ d["timestamp"] for d in car_datas ]
+        return {
+            '$push': { "fields.{}".format(f): {'$each': [ d[ f ] for d in car_datas ]} for f in CAR_DATA_FIELDS },
+            '$inc': {"count": len(car_datas)},
+            '$min': {"min_timestamp": min(timestamps)},
+            '$max': {"max_timestamp": max(timestamps)}
+        }
+
+    def insert(self, car_data):
+        self.collection.update_one({"session_uid": car_data["session_uid"], "count": {'$lt': self.bucket_size}},
+                                   self._push_update([ car_data ]),
+                                   upsert=True)
+        return None
+
+    def insert_many(self, car_datas):
+        by_session = OrderedDict()
+        for car_data in car_datas:
+            by_session.setdefault(car_data["session_uid"], []).append(car_data)
+
+        for uid, samples in by_session.items():
+            start = 0
+            bucket = self.collection.find_one({"session_uid": uid, "count": {'$lt': self.bucket_size}},
+                                              {"count": True})
+            if bucket is not None:
+                start = self.bucket_size - bucket["count"]
+                self.collection.update_one({"_id": bucket["_id"]}, self._push_update(samples[ :start ]))
+
+            new_buckets = [ self._new_bucket(uid, samples[ i:i + self.bucket_size ])
+                            for i in range(start, len(samples), self.bucket_size) ]
+            if new_buckets:
+                self.collection.insert_many(new_buckets, ordered=True)
+        return []
+
+    @staticmethod
+    def unpack(bucket):
+        uid = bucket["session_uid"]
+        fields = bucket["fields"]
+        names = [ f for f in CAR_DATA_FIELDS if f in fields ]
+        columns = [ fields[ f ] for f in names ]
+        car_datas = []
+        for values in zip(*columns):
+            car_data = dict(zip(names, values))
+            car_data["session_uid"] = uid
+            car_datas.append(car_data)
+        car_datas.sort(key=lambda d: d["timestamp"])
+        return car_datas
+
+    def find(self, uid, offset=None, limit=None):
+        offset = offset or 0
+        mongo_objects = self.collection\
+            .find({"session_uid": uid}, {'_id': False}) \
+            .sort("min_timestamp", 1)
+
+        car_datas = []
+        for bucket in mongo_objects:
+            if offset >= bucket["count"]:
+                offset -= bucket["count"]
+                continue
+            car_datas.extend(self.unpack(bucket)[ offset: ])
+            offset = 0
+            if limit is not None and len(car_datas) >= limit:
+                del car_datas[ limit: ]
+                break
+        return car_datas
+
+    def iter(self, uid, after=None, fields=None, batch_size=1000, limit=None):
+        query = {"session_uid": uid}
+        if after is not None:
+            query["max_timestamp"] = {'$gt': after}
+
+        projection = {'_id': False, "session_uid": True}
+        if fields is None:
+            projection["fields"] = True
+        else:
+            projection.update({"fields.{}".format(f): True for f in fields})
+            projection["fields.timestamp"] = True
+
+        mongo_objects = self.collection\
+            .find(query, projection) \
+            .sort("min_timestamp", 1) \
+            .batch_size(max(1, batch_size // self.bucket_size))
+
+        count = 0
+        for bucket in mongo_objects:
+            for car_data in self.unpack(bucket):
+                if after is not None and car_data["timestamp"] <= after:
+                    continue
+                if limit is not None and count >= limit:
+                    return
+                count += 1
+                yield car_data
+
+    def page(self, uid, after=None, fields=None, limit=1000):
+        # (car datas, cursor of the next page or None), keyset paginated on the buckets sorted by
+        # (min_timestamp, _id) and the position of the sample in its unpacked bucket
+        query = {"session_uid": uid}
+        if after is not None:
+            after_min_timestamp, after_id, after_position = after
+            query['$or'] = [ {"min_timestamp": {'$gt': after_min_timestamp}},
+                             {"min_timestamp": after_min_timestamp, "_id": {'$gte': after_id}} ]
+
+        projection = {"session_uid": True, "min_timestamp": True}
+        if fields is None:
+            projection["fields"] = True
+        else:
+            projection.update({"fields.{}".format(f): True for f in fields})
+            projection["fields.timestamp"] = True
+
+        mongo_objects = self.collection\
+            .find(query, projection) \
+            .sort([ ("min_timestamp", ASCENDING), ("_id", ASCENDING) ]) \
+            .batch_size(max(1, limit // self.bucket_size + 1))
+
+        car_datas = []
+        for bucket in mongo_objects:
+            start = after_position + 1 if after is not None and bucket[ "_id" ] == after_id else 0
+            for position, car_data in enumerate(self.unpack(bucket)[ start: ], start):
+                car_datas.append(car_data)
+                if len(car_datas) == limit:
+                    return car_datas, (bucket[ "min_timestamp" ], bucket[ "_id" ], position)
+        return car_datas, None
+
+    def update_field(self, uid, field, timestamps, values):
+        values_by_timestamp = dict(zip(timestamps, values))
+        buckets = self.collection.find({"session_uid": uid}, {"fields.timestamp": True, "fields.{}".format(field): True})
+
+        updated = 0
+        for bucket in buckets:
+            column = bucket["fields"].get(field, [])
+            bucket_timestamps = bucket["fields"]["timestamp"]
+            new_column = [ values_by_timestamp.get(t, column[ i ] if i < len(column) else None)
+                           for i, t in enumerate(bucket_timestamps) ]
+            self.collection.update_one({"_id": bucket["_id"]}, {'$set': {"fields.{}".format(field): new_column}})
+            updated += len(new_column)
+        return updated
+
+    def delete(self, uid):
+        return self.collection.delete_many({"session_uid": uid}).deleted_count
+
+    def session_uids(self):
+        return self.collection.distinct("session_uid")
+
+    def sample_pipeline(self, uid, fields):
+        return [
+            {'$match': {"session_uid": uid}},
+            {'$project': {"_id": False,
+                          "samples": {'$zip': {"inputs": [ "$fields.{}".format(f) for f in fields ]}}}},
+            {'$unwind': "$samples"},
+            {'$project': {f: {'$arrayElemAt': [ "$samples", i ]} for i, f in enumerate(fields)}}
+        ]
+
+    def queries(self, uid):
+        return [
+            ("get_car_data", self.collection.find({"session_uid": uid}, {'_id': False}).sort("min_timestamp", 1)),
+            ("open_bucket", self.collection.find({"session_uid": uid, "count": {'$lt': self.bucket_size}},
+                                                 {"count": True}))
+        ]
+
+    def migrate_from(self, storage, session_uid=None, drop_source=False):
+        if session_uid is None:
+            session_uids = storage.session_uids()
+        else:
+            session_uids = [ session_uid ]
+
+        migrated = 0
+        for uid in session_uids:
+            car_datas = storage.find(uid)
+            self.delete(uid)
+            for i in range(0, len(car_datas), self.bucket_size):
+                self.collection.insert_one(self._new_bucket(uid, car_datas[ i:i + self.bucket_size ]))
+            self.logger.info("[DATABASE] Migrated {} car datas of session {} to buckets".format(len(car_datas), uid))
+            migrated += len(car_datas)
+
+            if drop_source:
+                storage.delete(uid)
+        return migrated
+
+
+STORAGES = {
+    "document": DocumentStorage,
+    "bucket": BucketStorage
+}
+
+
+if __name__ == '__main__':
+    from autopial_lib.MongoDatabaseDriver.MongoClients import get_client
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Convert per-sample car_data documents into bucket documents")
+    parser.add_argument("--db-path", default="mongodb://localhost:27017/")
+    parser.add_argument("--db-name", default="autopial-cardb")
+    parser.add_argument("--session", default=None, help="only migrate this session uid")
+    parser.add_argument("--bucket-size", type=int, default=1000)
+    parser.add_argument("--drop-source", action="store_true", help="delete migrated car_data documents")
+    args = parser.parse_args()
+
+    database = get_client(args.db_path)[ args.db_name ]
+    buckets = BucketStorage(database, bucket_size=args.bucket_size)
+    count = buckets.migrate_from(DocumentStorage(database), session_uid=args.session, drop_source=args.drop_source)
+    print("{} car datas migrated".format(count))
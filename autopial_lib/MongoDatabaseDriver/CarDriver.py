@@ -2,28 +2,167 @@
 # -*- coding: utf-8 -*-
 import datetime
 import logging
+import threading
+import time
+from collections import OrderedDict
 
 import pymongo
-from pymongo import MongoClient
+from pymongo import ASCENDING, DESCENDING, UpdateOne, WriteConcern
+
+from autopial_lib.MongoDatabaseDriver import MongoClients
+from autopial_lib.MongoDatabaseDriver.CarDataStorage import STORAGES
+from autopial_lib.car_samples import CarSamples
+from autopial_lib.metrics import metrics
 
 class CarDriver():
     COLLECTION_SESSION = "car_session"
     COLLECTION_DATA = "car_data"
+    # precomputed downsampled series of terminated sessions
+    COLLECTION_LOD = "car_data_lod"
+
+    SESSION_INDEXES = [
+        ([("uid", ASCENDING)], {"name": "uid", "unique": True}),
+        # session listings, see list_sessions()
+        ([("start_date", DESCENDING), ("uid", DESCENDING)], {"name": "start_date_uid"}),
+        ([("status", ASCENDING), ("start_date", DESCENDING), ("uid", DESCENDING)], {"name": "status_start_date_uid"})
+    ]
+    # session fields returned by list_sessions(), enough to render a list of trips
+    SESSION_LIST_FIELDS = ("uid", "origin", "status", "start_date", "end_date", "duration", "distance",
+                           "first_address", "last_address", "nbr_car_datas")
+    LOD_INDEXES = [
+        ([("session_uid", ASCENDING), ("key", ASCENDING)], {"name": "session_uid_key", "unique": True})
+    ]
 
-    def __init__(self, db_path, db_name="autopial-cardb", logger=None):
+    # session state is journaled before being acknowledged, samples only wait for the primary
+    # to apply them. w=0 for samples is possible with the document storage only: bucket
+    # storage reads back the bucket it appends to
+    WRITE_CONCERNS = {
+        COLLECTION_SESSION: WriteConcern(w=1, j=True),
+        "car_data": WriteConcern(w=1, j=False),
+        "car_data_bucket": WriteConcern(w=1, j=False),
+    }
+
+    def __init__(self, db_path, db_name="autopial-cardb", logger=None,
+                 buffered=False, buffer_size=500, buffer_max_age=2.0,
+                 storage="document", bucket_size=1000, write_concerns=None, config=None):
         if logger is None:
             self.logger = logging.getLogger(__name__)
         else:
             self.logger = logger
 
+        # write-behind mode: samples are kept in memory and written with
+        # insert_many/bulk_write once buffer_size or buffer_max_age (seconds) is reached.
+        # A background thread flushes samples older than buffer_max_age when no new sample
+        # comes in to trigger it, close() stops it
+        self.buffered = buffered
+        self.buffer_size = buffer_size
+        self.buffer_max_age = buffer_max_age
+        self._buffer = []
+        self._buffer_first_date = None
+        self._buffer_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+        self.flush_count = 0
+        self.flushed_car_datas = 0
+        self.last_flush_duration = 0.0
+        self.max_flush_duration = 0.0
+        self.total_flush_duration = 0.0
+
+        # car data layout: "document" (one document per sample) or "bucket" (columnar bucket documents)
+        self._storage_name = storage
+        self._bucket_size = bucket_size
+
+        # collection name -> WriteConcern, overriding WRITE_CONCERNS
+        self.write_concerns = dict(self.WRITE_CONCERNS, **(write_concerns or {}))
+        if config is not None:
+            MongoClients.configure(config)
+
         self.connect(db_path, db_name)
 
+        self._flusher_stopevent = threading.Event()
+        self._flusher = None
+        if buffered and buffer_max_age:
+            self._flusher = threading.Thread(target=self._run_flusher, name="car-driver-flusher")
+            self._flusher.daemon = True
+            self._flusher.start()
+
     def connect(self, db_path, db_name):
         self._db_path = db_path
         self._db_name = db_name
-        client = MongoClient(db_path)
+        client = MongoClients.get_client(db_path)
         self.database = client[db_name]
+        self._collections = {}
+
+        storage_class = STORAGES[ self._storage_name ]
+        write_concern = self.write_concerns.get(storage_class.COLLECTION)
+        if self._storage_name == "bucket":
+            self.storage = storage_class(self.database, self.logger, bucket_size=self._bucket_size,
+                                         write_concern=write_concern)
+        else:
+            self.storage = storage_class(self.database, self.logger, write_concern=write_concern)
+
+        self.ensure_indexes()
+
+    def collection(self, name):
+        # collection with the write concern configured for it
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self.database.get_collection(name, write_concern=self.write_concerns.get(name))
+            self._collections[ name ] = collection
+        return collection
+
+    def ensure_indexes(self):
+        indexes = [ (self.collection(self.COLLECTION_SESSION), keys, options) for keys, options in self.SESSION_INDEXES ]
+        indexes += [ (self.storage.collection, keys, options) for keys, options in self.storage.INDEXES ]
+        indexes += [ (self.collection(self.COLLECTION_LOD), keys, options) for keys, options in self.LOD_INDEXES ]
+
+        created = []
+        for collection, keys, options in indexes:
+            try:
+                created.append(collection.create_index(keys, **options))
+            except pymongo.errors.OperationFailure as e:
+                self.logger.error("[DATABASE] Unable to create index {} on '{}': {}".format(
+                    options["name"], collection.name, e))
+        self.logger.debug("[DATABASE] Indexes ensured: {}".format(created))
+        return created
 
+    def explain_queries(self, session_uid=""):
+        session_collection = self.collection(self.COLLECTION_SESSION)
+        queries = [
+            ("get_session", session_collection.find({"uid": session_uid})),
+            ("update_session", session_collection.find({"uid": session_uid})),
+        ]
+        queries += self.storage.queries(session_uid)
+
+        reports = []
+        for name, cursor in queries:
+            winning_plan = cursor.explain()["queryPlanner"]["winningPlan"]
+            stages = []
+            plan = winning_plan
+            while plan is not None:
+                stages.append(plan["stage"])
+                if "inputStage" in plan:
+                    plan = plan["inputStage"]
+                elif plan.get("inputStages"):
+                    plan = plan["inputStages"][0]
+                else:
+                    plan = None
+
+            reports.append(dict(name=name,
+                                collection=cursor.collection.name,
+                                stages=stages,
+                                uses_index="COLLSCAN" not in stages,
+                                in_memory_sort="SORT" in stages))
+        return reports
+
+    def check_query_plans(self, session_uid=""):
+        unindexed = []
+        for report in self.explain_queries(session_uid):
+            if not report["uses_index"] or report["in_memory_sort"]:
+                self.logger.warning("[DATABASE] Query '{}' on '{}' is not served by an index: {}".format(
+                    report["name"], report["collection"], " <- ".join(report["stages"])))
+                unindexed.append(report["name"])
+        return unindexed
 
     def create_session(self, session_uid, origin, start_date=datetime.datetime.now()):
         autopial_session = self.get_session(session_uid)
@@ -35,8 +174,8 @@ class CarDriver():
                      start_date=start_date,
                      last_comm=datetime.datetime.now(),
                      status="NOTSTARTED",
-                     car_datas=[])
-            autopial_session = self.database[self.COLLECTION_SESSION].insert_one(t)
+                     nbr_car_datas=0)
+            autopial_session = self.collection(self.COLLECTION_SESSION).insert_one(t)
         else:
             self.logger.info("[DATABASE] Autopial Session uid={} already exist".format(session_uid))
         return autopial_session
@@ -45,30 +184,74 @@ class CarDriver():
         if "_id" in kwargs:
             del kwargs["_id"]
 
-        autopial_session = self.get_session(session_uid=session_uid)
-        if autopial_session is None:
-            return False
-
         for field in kwargs:
-            #if field in autopial_session:
             self.logger.info("[DATABASE] Update Autopial Session uid={} {}={}".format(session_uid, field, kwargs[field]))
-            autopial_session[field] = kwargs[field]
 
-        autopial_session["last_comm"] = datetime.datetime.now()
-        result = self.database[ self.COLLECTION_SESSION ].update_one({"uid": session_uid}, {'$set': autopial_session})
+        kwargs["last_comm"] = datetime.datetime.now()
+        with metrics.timer("car_driver.update_session"):
+            result = self.collection(self.COLLECTION_SESSION).update_one({"uid": session_uid}, {'$set': kwargs})
         return result.modified_count
 
     def get_session(self, session_uid):
-        autopial_session = self.database[ self.COLLECTION_SESSION ].find_one({"uid": session_uid})
+        autopial_session = self.collection(self.COLLECTION_SESSION).find_one({"uid": session_uid})
         return autopial_session
 
     def get_all_sessions(self):
-        autopial_sessions = list(self.database[ self.COLLECTION_SESSION ].find())
+        autopial_sessions = list(self.collection(self.COLLECTION_SESSION).find({}, {"car_datas": False}))
         return autopial_sessions
 
-    def delete_session(self, session_uid):
+    def list_sessions(self, status=None, start=None, end=None, after=None, limit=50, fields=None):
+        """Sessions sorted by start_date, most recent first, as (sessions, next_after).
+
+        status is a status or a list of statuses, start/end bound start_date (end excluded).
+        after is the next_after of the previous page, None on the last page.
+        """
+        query = {}
+        if status is not None:
+            query["status"] = status if isinstance(status, str) else {'$in': list(status)}
+        if start is not None or end is not None:
+            query["start_date"] = {}
+            if start is not None:
+                query["start_date"]['$gte'] = start
+            if end is not None:
+                query["start_date"]['$lt'] = end
+        if after is not None:
+            # keyset pagination, uid breaks the ties between sessions started at the same date
+            after_date, after_uid = after
+            query = {'$and': [ query, {'$or': [ {"start_date": {'$lt': after_date}},
+                                                 {"start_date": after_date, "uid": {'$lt': after_uid}} ]} ]}
+
+        projection = { f: True for f in (fields or self.SESSION_LIST_FIELDS) }
+        projection.update(_id=False, uid=True, start_date=True)
+        autopial_sessions = list(self.collection(self.COLLECTION_SESSION)
+                                 .find(query, projection)
+                                 .sort([ ("start_date", DESCENDING), ("uid", DESCENDING) ])
+                                 .limit(limit))
+        if len(autopial_sessions) < limit:
+            return autopial_sessions, None
+        last = autopial_sessions[ -1 ]
+        return autopial_sessions, (last[ "start_date" ], last[ "uid" ])
+
+    def migrate_sessions(self):
+        # sessions created before nbr_car_datas embedded the ObjectId of every sample
+        result = self.collection(self.COLLECTION_SESSION).update_many(
+            {"car_datas": {'$exists': True}},
+            [
+                {'$set': {"nbr_car_datas": {'$size': "$car_datas"}}},
+                {'$unset': "car_datas"}
+            ]
+        )
+        self.logger.info("[DATABASE] Migrated {} session(s) to car data counters".format(result.modified_count))
+        return result.modified_count
+
+    def delete_session(self, session_uid, car_data=False):
         self.logger.info("[DATABASE] Deleting session: '{}'".format(session_uid))
-        result = self.database[ self.COLLECTION_SESSION ].delete_many({"uid": session_uid})
+        if car_data and self._buffer:
+            self.flush()
+        result = self.collection(self.COLLECTION_SESSION).delete_many({"uid": session_uid})
+        if car_data:
+            self.storage.delete(session_uid)
+            self.delete_lod(session_uid)
         return result.deleted_count
 
     def add_car_data(self, uid, timestamp, distance,
@@ -85,28 +268,243 @@ class CarDriver():
                          gps_speed=gps_speed, direction=direction,
                          obd_speed=obd_speed, rpm=rpm,coolant_temp=coolant_temp, oil_temp=oil_temp,
                          accel_x=accel_x, accel_y=accel_y, accel_z=accel_z)
-        mongo_object = self.database[ self.COLLECTION_DATA ].insert_one(car_data)
-
-        result = self.database[ self.COLLECTION_SESSION ].update_one(
-            {
-                "uid": uid
-            },
-            {
-                '$push': {
-                    "car_datas": mongo_object.inserted_id
+
+        if self.buffered:
+            with self._buffer_lock:
+                if not self._buffer:
+                    self._buffer_first_date = time.monotonic()
+                self._buffer.append(car_data)
+                must_flush = len(self._buffer) >= self.buffer_size or \
+                             time.monotonic() - self._buffer_first_date >= self.buffer_max_age
+            if must_flush:
+                self.flush()
+            return True
+
+        with metrics.timer("car_driver.insert"):
+            self.storage.insert(car_data)
+
+            result = self.collection(self.COLLECTION_SESSION).update_one(
+                {
+                    "uid": uid
+                },
+                {
+                    '$inc': {
+                        "nbr_car_datas": 1
+                    }
                 }
-            }
-        )
+            )
         return True
 
-    def get_car_data(self, uid, offset=None, limit=None):
-        mongo_objects = self.database[ self.COLLECTION_DATA ]\
-            .find({"session_uid": uid}, {'_id': False}) \
-            .sort("timestamp", 1)
+    @property
+    def queue_depth(self):
+        return len(self._buffer)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._buffer_lock:
+                car_datas = self._buffer
+                self._buffer = []
+                self._buffer_first_date = None
+
+            if not car_datas:
+                return 0
+
+            start = time.monotonic()
+            try:
+                self.storage.insert_many(car_datas)
+            except pymongo.errors.PyMongoError:
+                metrics.count("car_driver.flush_errors")
+                # keep the samples for the next flush attempt
+                with self._buffer_lock:
+                    self._buffer = car_datas + self._buffer
+                    self._buffer_first_date = start
+                raise
+
+            counts = OrderedDict()
+            for car_data in car_datas:
+                counts[ car_data["session_uid"] ] = counts.get(car_data["session_uid"], 0) + 1
+
+            requests = [UpdateOne({"uid": uid}, {'$inc': {"nbr_car_datas": count}})
+                        for uid, count in counts.items()]
+            self.collection(self.COLLECTION_SESSION).bulk_write(requests, ordered=False)
+            duration = time.monotonic() - start
+
+            self.flush_count += 1
+            self.flushed_car_datas += len(car_datas)
+            self.last_flush_duration = duration
+            self.total_flush_duration += duration
+            self.max_flush_duration = max(self.max_flush_duration, duration)
+            metrics.observe("car_driver.flush", duration)
+            metrics.count("car_driver.flushed_samples", len(car_datas))
+            self.logger.debug("[DATABASE] Flushed {} car datas in {} ms".format(
+                len(car_datas), round(duration * 1000, 2)))
+            return len(car_datas)
+
+    def _run_flusher(self):
+        while not self._flusher_stopevent.wait(self.buffer_max_age / 2):
+            with self._buffer_lock:
+                first_date = self._buffer_first_date
+            if first_date is None or time.monotonic() - first_date < self.buffer_max_age:
+                continue
+            try:
+                self.flush()
+            except Exception as e:
+                # the samples stay buffered, retried on the next tick
+                self.logger.error("[DATABASE] Background flush failed: {}".format(e))
+
+    def close(self):
+        # stops the background flusher and writes the remaining samples
+        self._flusher_stopevent.set()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        return self.flush()
+
+    def flush_stats(self):
+        return dict(queue_depth=self.queue_depth,
+                    flush_count=self.flush_count,
+                    flushed_car_datas=self.flushed_car_datas,
+                    last_flush_duration=self.last_flush_duration,
+                    max_flush_duration=self.max_flush_duration,
+                    avg_flush_duration=self.total_flush_duration / self.flush_count if self.flush_count else 0.0)
+
+    def get_car_data(self, uid, offset=None, limit=None, compact=False):
+        # list of car data dicts, or with compact=True CarSamples columns filled while streaming
+        # so the documents are never all in memory
+        if self._buffer:
+            self.flush()
+
+        if offset:
+            car_datas = self.storage.find(uid, offset, limit)
+        else:
+            car_datas = self.storage.iter(uid, limit=limit)
+        if compact:
+            return CarSamples.from_rows(car_datas, session_uid=uid)
+        return list(car_datas)
+
+    def iter_car_data(self, uid, after=None, fields=None, batch_size=1000, limit=None):
+        # streams samples sorted by timestamp, resuming strictly after the 'after' timestamp
+        if self._buffer:
+            self.flush()
+
+        return self.storage.iter(uid, after=after, fields=fields, batch_size=batch_size, limit=limit)
+
+    def get_car_data_page(self, uid, after=None, limit=1000, fields=None):
+        # (samples sorted by timestamp, cursor of the next page or None). The cursor is opaque and
+        # breaks the ties between samples sharing a timestamp, unlike iter_car_data(after=...)
+        if self._buffer:
+            self.flush()
+
+        return self.storage.page(uid, after=after, fields=fields, limit=limit)
+
+    def compute_session_aggregates(self, uid):
+        # server-side equivalent of the aggregates CarSession maintains while ingesting,
+        # for sessions recorded before they existed
+        if self._buffer:
+            self.flush()
+
+        has_fix = {'$and': [ {'$ne': [ "$latitude", 0 ]}, {'$ne': [ "$longitude", 0 ]} ]}
+        pipeline = self.storage.sample_pipeline(uid, ("timestamp", "distance", "latitude", "longitude")) + [
+            {'$sort': {"timestamp": 1}},
+            {'$facet': {
+                "all": [
+                    {'$group': {"_id": None,
+                                "nbr_car_datas": {'$sum': 1},
+                                "duration": {'$last': "$timestamp"},
+                                "distance": {'$last': "$distance"}}}
+                ],
+                "fixes": [
+                    {'$match': {'$expr': has_fix}},
+                    {'$group': {"_id": None,
+                                "min_lat": {'$min': "$latitude"},
+                                "min_lon": {'$min': "$longitude"},
+                                "max_lat": {'$max': "$latitude"},
+                                "max_lon": {'$max': "$longitude"},
+                                "start_lat": {'$first': "$latitude"},
+                                "start_lon": {'$first': "$longitude"},
+                                "end_lat": {'$last': "$latitude"},
+                                "end_lon": {'$last': "$longitude"}}}
+                ]
+            }}
+        ]
+        result = list(self.storage.collection.aggregate(pipeline, allowDiskUse=True))
+        if not result or not result[ 0 ][ "all" ]:
+            return None
+
+        aggregates = result[ 0 ][ "all" ][ 0 ]
+        del aggregates[ "_id" ]
+        aggregates.update(bbox=None, start_point=(0, 0), end_point=(0, 0))
+        if result[ 0 ][ "fixes" ]:
+            fixes = result[ 0 ][ "fixes" ][ 0 ]
+            aggregates.update(bbox=[ fixes["min_lat"], fixes["min_lon"], fixes["max_lat"], fixes["max_lon"] ],
+                              start_point=(fixes["start_lat"], fixes["start_lon"]),
+                              end_point=(fixes["end_lat"], fixes["end_lon"]))
+        return aggregates
+
+    def update_car_data_field(self, uid, field, timestamps, values):
+        # rewrites one field of the samples identified by their timestamp
+        if self._buffer:
+            self.flush()
+
+        return self.storage.update_field(uid, field, timestamps, values)
+
+    def downsample_car_data(self, uid, fields, points, unknown_values=None):
+        # min/max/avg of each field over 'points' buckets of equal duration, empty buckets omitted:
+        # [{"timestamp": bucket start, "count": n, field: {"min": .., "max": .., "avg": ..}}, ...]
+        # unknown_values maps a field to its "unknown" default (CarSession.UNKNOWN_VALUES), these
+        # values are ignored and a field unknown over a whole bucket has None statistics
+        unknown_values = unknown_values or {}
+        if points <= 0:
+            raise ValueError("points must be a positive number of buckets, got {}".format(points))
+        if self._buffer:
+            self.flush()
+
+        bounds = list(self.storage.collection.aggregate(self.storage.sample_pipeline(uid, ("timestamp",)) + [
+            {'$group': {"_id": None, "start": {'$min': "$timestamp"}, "end": {'$max': "$timestamp"}}}
+        ]))
+        if not bounds:
+            return []
+        start = bounds[ 0 ][ "start" ]
+        width = (bounds[ 0 ][ "end" ] - start) / points or 1.0
+
+        bucket = {'$floor': {'$divide': [ {'$subtract': [ "$timestamp", start ]}, width ]}}
+        group = {"_id": {'$min': [ bucket, points - 1 ]}, "count": {'$sum': 1}}
+        for f in fields:
+            known = "$" + f
+            if f in unknown_values:
+                # $min, $max and $avg skip nulls
+                known = {'$cond': [ {'$eq': [ known, unknown_values[ f ] ]}, None, known ]}
+            group[ f + "_min" ] = {'$min': known}
+            group[ f + "_max" ] = {'$max': known}
+            group[ f + "_avg" ] = {'$avg': known}
+        pipeline = self.storage.sample_pipeline(uid, ("timestamp",) + tuple(fields)) + [
+            {'$group': group},
+            {'$sort': {"_id": 1}}
+        ]
+
+        buckets = []
+        for result in self.storage.collection.aggregate(pipeline, allowDiskUse=True):
+            row = dict(timestamp=start + result[ "_id" ] * width, count=result[ "count" ])
+            for f in fields:
+                row[ f ] = dict(min=result[ f + "_min" ], max=result[ f + "_max" ], avg=result[ f + "_avg" ])
+            buckets.append(row)
+        return buckets
+
+    def get_lod(self, uid, key):
+        lod = self.collection(self.COLLECTION_LOD).find_one({"session_uid": uid, "key": key}, {"data": True})
+        return None if lod is None else lod[ "data" ]
+
+    def save_lod(self, uid, key, data):
+        self.collection(self.COLLECTION_LOD).replace_one({"session_uid": uid, "key": key},
+                                                        dict(session_uid=uid, key=key, data=data,
+                                                             created=datetime.datetime.now()),
+                                                        upsert=True)
 
-        if offset is not None:
-            mongo_objects.skip(offset)
-        if limit is not None:
-            mongo_objects.limit(limit)
+    def delete_lod(self, uid):
+        return self.collection(self.COLLECTION_LOD).delete_many({"session_uid": uid}).deleted_count
 
-        return list(mongo_objects)
\ No newline at end of file
+    def migrate_to_buckets(self, session_uid=None, drop_source=False):
+        document_storage = STORAGES["document"](self.database, self.logger)
+        bucket_storage = STORAGES["bucket"](self.database, self.logger, bucket_size=self._bucket_size,
+                                            write_concern=self.write_concerns.get(STORAGES["bucket"].COLLECTION))
+        return bucket_storage.migrate_from(document_storage, session_uid=session_uid, drop_source=drop_source)
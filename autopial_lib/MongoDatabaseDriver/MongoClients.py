@@ -0,0 +1,42 @@
+import logging
+import threading
+
+from pymongo import MongoClient
+
+logger = logging.getLogger(__name__)
+
+# connection pool options of the clients created by get_client(), see configure()
+POOL_OPTIONS = dict(maxPoolSize=20, minPoolSize=0, maxIdleTimeMS=60000)
+
+# ConfigFile key under 'mongodb' -> MongoClient option
+CONFIG_OPTIONS = dict(max_pool_size="maxPoolSize", min_pool_size="minPoolSize", max_idle_time_ms="maxIdleTimeMS")
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def configure(config):
+    # pool options from the 'mongodb' section of a ConfigFile, for the clients created afterwards
+    for key, option in CONFIG_OPTIONS.items():
+        POOL_OPTIONS[ option ] = config.get("mongodb", key, default=POOL_OPTIONS[ option ])
+    logger.info("[DATABASE] MongoClient pool options: {}".format(POOL_OPTIONS))
+
+
+def get_client(uri):
+    """Process wide MongoClient of a URI. MongoClient is thread safe and pools its
+    connections, one instance per URI is shared by every CarDriver of the process."""
+    client = _clients.get(uri)
+    if client is None:
+        with _lock:
+            client = _clients.get(uri)
+            if client is None:
+                client = MongoClient(uri, **POOL_OPTIONS)
+                _clients[ uri ] = client
+    return client
+
+
+def close_clients():
+    with _lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
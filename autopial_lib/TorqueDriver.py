@@ -1,10 +1,18 @@
 import csv
 import datetime
+import functools
+import itertools
+import json
 import logging
+import operator
 
+import numpy as np
 import os
+import time
 
-from autopial_lib.utils import safe_value
+from autopial_lib.car_samples import CAR_DATA_FIELDS, CarSamples
+from autopial_lib.metrics import metrics
+from autopial_lib.utils import safe_float, safe_value
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -41,6 +49,34 @@ def parse_date(torque_dt):
     return dt
 
 
+TORQUE_MONTH_NUMBERS = { m: int(n) for m, n in TORQUE_MONTHS.items() }
+
+# CSV rows held as strings at once by read_array(), the parsed chunks are float64 only
+READ_CHUNK_ROWS = 10000
+
+
+@functools.lru_cache(maxsize=256)
+def _torque_second(whole_seconds):
+    # '11-mai-2016 20:23:42' -> (year, month, day, hour, minute, second), rows logged several
+    # times per second share it
+    day_part, hms = whole_seconds.split(" ", 1)
+    day, month, year = day_part.split("-")
+    hour, minute, second = hms.split(":")
+    return int(year), TORQUE_MONTH_NUMBERS[ month ], int(day), int(hour), int(minute), int(second)
+
+
+def torque_date(torque_dt):
+    # fast path for the usual '11-mai-2016 20:23:42.123' device time, parse_date() otherwise
+    try:
+        whole_seconds, _, fraction = torque_dt.partition(".")
+        return datetime.datetime(*_torque_second(whole_seconds), int(fraction.ljust(6, "0")[ :6 ]) if fraction else 0)
+    except (ValueError, KeyError):
+        dt = parse_date(torque_dt)
+        if dt is None:
+            raise ValueError("Invalid Torque date '{}'".format(torque_dt))
+        return dt
+
+
 def safe_torque_value(value):
     if value == "-":
         return 0.0
@@ -89,10 +125,23 @@ TORQUE_MAPPER = {
 }
 
 
+def _values_getter(indexes):
+    # always returns a tuple, unlike a bare itemgetter on 0 or 1 index
+    if len(indexes) == 0:
+        return lambda values: ()
+    if len(indexes) == 1:
+        index = indexes[ 0 ]
+        return lambda values: (values[ index ],)
+    return operator.itemgetter(*indexes)
+
+
 class TorqueFileReader():
 
-    def __init__(self, filepath):
+    def __init__(self, filepath, encoding="utf-8"):
         self.isReady = False
+        self.filepath = None
+        self.encoding = encoding
+        self.bytes_read = 0
         self.__parsing_results = {
             "missing_fields": set(),
             "not_supported_fields": set()
@@ -104,8 +153,10 @@ class TorqueFileReader():
 
     def set_file(self, filepath):
         self.start_date = None
+        self._header = None
+        self._columns = None
         if not os.path.exists(filepath):
-            logger.error("Filepath '{}' does not exist !")
+            logger.error("Filepath '{}' does not exist !".format(filepath))
             self.isReady = False
             return None
 
@@ -114,79 +165,398 @@ class TorqueFileReader():
         self.filesize = float(os.path.getsize(filepath))
         logger.info(" + file size: {} MB".format(round(self.filesize / 1024 / 1024, 4)))
 
-        self.num_lines = sum(1 for line in open(filepath))
-        with open(self.filepath, newline='') as csvfile:
-            reader = csv.DictReader(csvfile)
+        # only the header and the first row are read here, readline() does the single full pass
+        with open(self.filepath, newline='', encoding=self.encoding) as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            row = next(reader, None)
+
+        if header is None or row is None:
+            logger.error("Unable to parse file {}".format(filepath))
+            return
 
-            for row in reader:
-                line = self.parse_row(row)
-                if line is None:
-                    logger.error("Unable to parse file {}".format(filepath))
-                    return
+        self.compile_header(header)
+        line = self.parse_values(row)
+        if line is None:
+            logger.error("Unable to parse file {}".format(filepath))
+            return
 
-                for k in TORQUE_MAPPER:
-                    if TORQUE_MAPPER[k] not in line:
-                        self.__parsing_results[ "missing_fields" ].add(TORQUE_MAPPER[k])
-                break
+        for k in TORQUE_MAPPER:
+            if TORQUE_MAPPER[k] not in line:
+                self.__parsing_results[ "missing_fields" ].add(TORQUE_MAPPER[k])
 
         logger.info(" + missing fields: {}".format(self.__parsing_results[ "missing_fields" ]))
         logger.info(" + not supported fields: {}".format(self.__parsing_results[ "not_supported_fields" ]))
         logger.info(" + start date: {}".format(self.start_date))
         self.isReady = True
 
-    def parse_row(self, row):
-        line = {}
-        for k in row:
-            try:
-                key = TORQUE_MAPPER[ k ]
-            except KeyError as e:
-                # logger.debug("Invalid key: '{}'".format(k))
-                self.__parsing_results[ "not_supported_fields" ].add(k)
+    def compile_header(self, header):
+        # column index -> field resolved once per header; a later duplicated field wins
+        # as with the original dict based parsing
+        self._header = list(header)
+        indexes = {}
+        for index, name in enumerate(header):
+            key = TORQUE_MAPPER.get(name)
+            if key is None:
+                self.__parsing_results[ "not_supported_fields" ].add(name)
                 continue
-            v = row[ k ]
-            value = safe_torque_value(v)
+            indexes.pop(key, None)
+            indexes[ key ] = index
 
-            if value is None:
-                return None
+        self._date_index = indexes.pop("datetime", None)
+        self._float_columns = indexes
+        # plain float() for every column until a '-' placeholder shows up in one of them
+        self._group_float_columns(set())
 
-            if key == "datetime":
-                if self.start_date is None:
-                    self.start_date = value
-                    line[ "timestamp" ] = 0
-                else:
-                    line[ "timestamp" ] = (value - self.start_date).total_seconds()
-            line[ key ] = value
-
-        if "latitude" not in line or \
-                "longitude" not in line:
+        self._has_position = "latitude" in indexes and "longitude" in indexes
+        if not self._has_position:
             logger.error("Missing mandatory field 'latitude/longitude'")
+        return indexes
+
+    def _group_float_columns(self, dashed_keys):
+        self._dashed_keys = [ k for k in self._float_columns if k in dashed_keys ]
+        self._dashed_getter = _values_getter([ self._float_columns[ k ] for k in self._dashed_keys ])
+        self._plain_keys = [ k for k in self._float_columns if k not in dashed_keys ]
+        self._plain_getter = _values_getter([ self._float_columns[ k ] for k in self._plain_keys ])
+
+    def _parse_floats(self, values):
+        try:
+            line = dict(zip(self._plain_keys, map(float, self._plain_getter(values))))
+        except ValueError:
+            dashed_keys = set(self._dashed_keys)
+            dashed_keys.update(k for k, i in self._float_columns.items() if values[ i ] == "-")
+            if len(dashed_keys) == len(self._dashed_keys):
+                raise
+            self._group_float_columns(dashed_keys)
+            line = dict(zip(self._plain_keys, map(float, self._plain_getter(values))))
+
+        if self._dashed_keys:
+            line.update(zip(self._dashed_keys, [ 0.0 if v == "-" else float(v) for v in self._dashed_getter(values) ]))
+        return line
+
+    def parse_values(self, values):
+        if not self._has_position:
+            return None
+
+        try:
+            line = self._parse_floats(values)
+            dt = None if self._date_index is None else torque_date(values[ self._date_index ])
+        except (ValueError, IndexError):
             return None
 
-        if line[ "longitude" ] == 0 and line[ "longitude" ] == 0:
-            line[ "fix" ] = 0
-        else:
-            line[ "fix" ] = 1
+        if dt is not None:
+            line[ "datetime" ] = dt
+            if self.start_date is None:
+                self.start_date = dt
+                line[ "timestamp" ] = 0
+            else:
+                line[ "timestamp" ] = (dt - self.start_date).total_seconds()
 
+        line[ "fix" ] = 0 if line[ "latitude" ] == 0 and line[ "longitude" ] == 0 else 1
         return line
 
+    def parse_row(self, row):
+        # dict based entry point, e.g. for csv.DictReader rows
+        header = list(row)
+        if header != self._header:
+            self.compile_header(header)
+        return self.parse_values(list(row.values()))
+
     def readline(self):
         if self.filepath is None:
             logger.error("Set valid filepath first !")
             return None
 
-        with open(self.filepath, newline='') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                line = self.parse_row(row)
-                if line is None:
-                    logger.error("Invalid data near line {} ".format(reader.line_num))
-                    continue
+        self.bytes_read = 0
+        with open(self.filepath, newline='', encoding=self.encoding) as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if header is None:
+                return None
+            self.compile_header(header)
+
+            # per row timing only when metrics are enabled, the loop stays as is otherwise.
+            # Row counts are reported once, when the generator ends or is closed
+            timed = metrics.enabled
+            debug = logger.isEnabledFor(logging.DEBUG)
+            parse_values = self.parse_values
+            rows = invalid_rows = 0
+            try:
+                for row in reader:
+                    if timed:
+                        start = time.perf_counter()
+                        line = parse_values(row)
+                        metrics.observe("torque.parse_row", time.perf_counter() - start)
+                    else:
+                        line = parse_values(row)
+                    if line is None:
+                        invalid_rows += 1
+                        logger.error("Invalid data near line {} ".format(reader.line_num))
+                        continue
+                    rows += 1
+
+                    if debug and (reader.line_num % 500) == 0:
+                        # position of the underlying binary buffer: progress without counting lines first
+                        self.bytes_read = f.buffer.tell()
+                        logger.debug(" * parsing line {} ({}%)".format(reader.line_num, self.progress()))
+                    yield line
+            finally:
+                metrics.count("torque.rows", rows)
+                if invalid_rows:
+                    metrics.count("torque.invalid_rows", invalid_rows)
+            self.bytes_read = self.filesize
+        return None
+
+    def progress(self):
+        if not self.filesize:
+            return 100.0
+        return round(100.0 * self.bytes_read / self.filesize, 1)
+
+    def checkpoint_path(self):
+        return self.filepath + ".autopial.checkpoint.json"
 
-                if (reader.line_num % 500) == 0:
-                    logger.debug(" * parsing line {} / {}".format(reader.line_num, self.num_lines))
-                yield line
+    def load_checkpoint(self, checkpoint_path):
+        if not os.path.exists(checkpoint_path):
+            return None
+        try:
+            with open(checkpoint_path, 'r') as f:
+                checkpoint = json.load(f)
+        except ValueError as e:
+            logger.warning("Ignoring corrupted checkpoint '{}': {}".format(checkpoint_path, e))
+            return None
+
+        if checkpoint.get("filepath") != self.filepath or os.path.getsize(self.filepath) < checkpoint[ "offset" ]:
+            # another file, or the log was truncated/rotated since
+            return None
+        return checkpoint
+
+    def save_checkpoint(self, checkpoint_path, offset, header):
+        checkpoint = dict(filepath=self.filepath,
+                          offset=offset,
+                          header=header,
+                          start_date=self.start_date.strftime("%Y-%m-%dT%H:%M:%S.%f") if self.start_date else None)
+        with open(checkpoint_path + ".tmp", 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(checkpoint_path + ".tmp", checkpoint_path)
+
+    def follow(self, checkpoint_path=None, poll_interval=1.0, checkpoint_interval=5.0, stop_event=None):
+        # yields the rows appended to a growing log, forever or until stop_event is set.
+        # The byte offset of the last consumed row is saved to checkpoint_path at most every
+        # checkpoint_interval seconds, when the end of the file is reached and when the
+        # generator is closed, so a restarted reader resumes there without reparsing
+        if self.filepath is None:
+            logger.error("Set valid filepath first !")
+            return None
+
+        if checkpoint_path is None:
+            checkpoint_path = self.checkpoint_path()
+
+        offset = 0
+        header = None
+        self.start_date = None
+        checkpoint = self.load_checkpoint(checkpoint_path)
+        if checkpoint is not None:
+            offset = checkpoint[ "offset" ]
+            header = checkpoint[ "header" ]
+            if header is not None:
+                self.compile_header(header)
+            if checkpoint[ "start_date" ] is not None:
+                self.start_date = datetime.datetime.strptime(checkpoint[ "start_date" ], "%Y-%m-%dT%H:%M:%S.%f")
+            logger.info("Following '{}' from byte {}".format(self.filepath, offset))
+
+        saved_offset = offset
+        saved_date = time.monotonic()
+        with open(self.filepath, 'rb') as f:
+            f.seek(offset)
+            try:
+                while stop_event is None or not stop_event.is_set():
+                    raw_line = f.readline()
+                    if not raw_line.endswith(b"\n"):
+                        # end of file or row still being written: wait for more data
+                        f.seek(offset)
+                        if offset != saved_offset:
+                            self.save_checkpoint(checkpoint_path, offset, header)
+                            saved_offset, saved_date = offset, time.monotonic()
+
+                        if os.path.getsize(self.filepath) < offset:
+                            logger.warning("'{}' was truncated, following it from the beginning".format(self.filepath))
+                            offset = 0
+                            header = None
+                            self.start_date = None
+                            f.seek(0)
+                            continue
+
+                        if stop_event is None:
+                            time.sleep(poll_interval)
+                        else:
+                            stop_event.wait(poll_interval)
+                        continue
+
+                    offset += len(raw_line)
+                    self.bytes_read = offset
+                    values = next(csv.reader([ raw_line.decode(self.encoding) ]), None)
+                    if not values:
+                        continue
+                    if header is None:
+                        header = values
+                        self.compile_header(header)
+                        continue
+
+                    line = self.parse_values(values)
+                    if line is None:
+                        logger.error("Invalid data near byte {} ".format(offset))
+                        continue
+
+                    yield line
+
+                    if time.monotonic() - saved_date >= checkpoint_interval:
+                        self.save_checkpoint(checkpoint_path, offset, header)
+                        saved_offset, saved_date = offset, time.monotonic()
+            finally:
+                if offset != saved_offset:
+                    self.save_checkpoint(checkpoint_path, offset, header)
         return None
 
+    def cache_paths(self):
+        return self.filepath + ".autopial.npy", self.filepath + ".autopial.json"
+
+    def _load_cache(self):
+        array_path, meta_path = self.cache_paths()
+        if not os.path.exists(array_path) or not os.path.exists(meta_path):
+            return None
+
+        stat = os.stat(self.filepath)
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+        except ValueError:
+            return None
+        if meta.get("size") != stat.st_size or meta.get("mtime") != stat.st_mtime:
+            return None
+
+        if meta.get("start_date") is not None:
+            self.start_date = datetime.datetime.strptime(meta[ "start_date" ], "%Y-%m-%dT%H:%M:%S.%f")
+        return np.load(array_path, mmap_mode='r')
+
+    def _save_cache(self, array):
+        array_path, meta_path = self.cache_paths()
+        stat = os.stat(self.filepath)
+        meta = dict(size=stat.st_size,
+                    mtime=stat.st_mtime,
+                    start_date=self.start_date.strftime("%Y-%m-%dT%H:%M:%S.%f") if self.start_date else None)
+
+        try:
+            with open(array_path + ".tmp", 'wb') as f:
+                np.save(f, array)
+            os.replace(array_path + ".tmp", array_path)
+            with open(meta_path + ".tmp", 'w') as f:
+                json.dump(meta, f)
+            os.replace(meta_path + ".tmp", meta_path)
+        except OSError:
+            # don't leave half-written files (e.g. disk full) next to the logs
+            for path in (array_path + ".tmp", meta_path + ".tmp"):
+                if os.path.isfile(path):
+                    os.remove(path)
+            raise
+
+    def read_array(self, cache=False):
+        # whole log as a structured array of float64 columns named after TORQUE_MAPPER targets,
+        # 'timestamp' in seconds from start_date and 'fix'. Caching is opt-in: with cache=True the parsed
+        # array is stored next to the CSV and memory-mapped on the next load
+        if self.filepath is None:
+            logger.error("Set valid filepath first !")
+            return None
+
+        if cache:
+            array = self._load_cache()
+            if array is not None:
+                logger.info("Loaded Torque file '{}' from cache".format(self.filepath))
+                return array
+
+        start = time.perf_counter()
+        chunks = []
+        invalid = 0
+        with open(self.filepath, newline='', encoding=self.encoding) as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if header is None:
+                return None
+            self.compile_header(header)
+            if not self._has_position:
+                return None
+
+            names = list(self._float_columns) + ([ "timestamp" ] if self._date_index is not None else []) + [ "fix" ]
+            dtype = [ (name, np.float64) for name in sorted(names, key=lambda k: (k != "timestamp", k)) ]
+            while True:
+                rows = list(itertools.islice(reader, READ_CHUNK_ROWS))
+                if not rows:
+                    break
+                chunk, skipped = self._parse_chunk([ row for row in rows if len(row) == len(header) ], dtype)
+                chunks.append(chunk)
+                invalid += skipped
+
+        if invalid:
+            logger.error("{} invalid row(s) skipped in '{}'".format(invalid, self.filepath))
+        array = np.concatenate(chunks) if chunks else np.empty(0, dtype=dtype)
+        metrics.observe("torque.read_array", time.perf_counter() - start)
+        metrics.count("torque.rows", len(array))
+
+        if cache:
+            try:
+                self._save_cache(array)
+            except OSError as e:
+                # e.g. a read-only log folder, the parsed array is still good
+                logger.warning("Unable to cache Torque file '{}': {}".format(self.filepath, e))
+                return array
+            return np.load(self.cache_paths()[ 0 ], mmap_mode='r')
+        return array
+
+    def _parse_chunk(self, rows, dtype):
+        # (structured array of the valid rows, number of invalid rows) for a chunk of CSV rows
+        valid = np.ones(len(rows), dtype=bool)
+        columns = {}
+        for key, index in self._float_columns.items():
+            raw_values = [ "0" if row[ index ] == "-" else row[ index ] for row in rows ]
+            try:
+                values = np.array(raw_values, dtype=np.float64)
+            except ValueError:
+                values = np.array([ safe_float(v, np.nan) for v in raw_values ], dtype=np.float64)
+                valid &= ~np.isnan(values)
+            columns[ key ] = values
+
+        if self._date_index is not None:
+            timestamps = np.full(len(rows), np.nan)
+            for i, row in enumerate(rows):
+                try:
+                    dt = torque_date(row[ self._date_index ])
+                except ValueError:
+                    continue
+                if self.start_date is None:
+                    self.start_date = dt
+                timestamps[ i ] = (dt - self.start_date).total_seconds()
+            valid &= ~np.isnan(timestamps)
+            columns[ "timestamp" ] = timestamps
+
+        columns[ "fix" ] = ((columns[ "latitude" ] != 0) | (columns[ "longitude" ] != 0)).astype(np.float64)
+
+        chunk = np.empty(int(valid.sum()), dtype=dtype)
+        for name in chunk.dtype.names:
+            chunk[ name ] = columns[ name ][ valid ]
+        return chunk, len(rows) - len(chunk)
+
+    def read_columns(self, cache=False):
+        array = self.read_array(cache=cache)
+        if array is None:
+            return None
+        return { name: array[ name ] for name in array.dtype.names }
+
+    def read_samples(self, cache=False):
+        # car data fields of the log as CarSamples, e.g. for CarSession consumers
+        array = self.read_array(cache=cache)
+        if array is None:
+            return None
+        return CarSamples.from_columns({ name: array[ name ] for name in CAR_DATA_FIELDS if name in array.dtype.names })
+
 
 if __name__ == '__main__':
     csvfile = TorqueFileReader("torque/trackLog-2016-mai-11_20-23-42.csv")
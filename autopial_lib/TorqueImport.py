@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import collections
+import datetime
+import glob
+import itertools
+import logging
+import multiprocessing
+import os
+import time
+
+from autopial_lib.Controller.CarController import CarController, CarSession
+from autopial_lib.MongoDatabaseDriver.CarDriver import CarDriver
+from autopial_lib.TorqueDriver import TorqueFileReader
+
+COLLECTION_IMPORT = "torque_import"
+
+
+def parse_torque_file(filepath):
+    # runs in a worker process: (filepath, start_date, structured array or None, parse duration)
+    start = time.monotonic()
+    reader = TorqueFileReader(filepath)
+    if not reader.isReady:
+        return filepath, None, None, time.monotonic() - start
+
+    array = reader.read_array(cache=False)
+    return filepath, reader.start_date, array, time.monotonic() - start
+
+
+class TorqueImporter():
+    """Imports Torque logs as car sessions, one session per file with the file path as origin.
+
+    Files are parsed in a process pool while the parent process feeds the samples to a
+    buffered CarDriver. Imported files are recorded with their size and mtime so a second
+    run skips them without parsing.
+    """
+
+    def __init__(self, db_driver, controller=None, processes=None, recreate=False, logger=None):
+        if logger is None:
+            self.logger = logging.getLogger(__name__)
+        else:
+            self.logger = logger
+
+        self.db_driver = db_driver
+        # a controller created here is closed by close()
+        self._owns_controller = controller is None
+        if controller is None:
+            controller = CarController(db_driver, logger=self.logger)
+        self.controller = controller
+        self.processes = processes
+        self.recreate = recreate
+        self.imports = db_driver.database[ COLLECTION_IMPORT ]
+
+    def close(self):
+        # waits for the addresses still being geocoded and stops the geocoding threads
+        if self._owns_controller:
+            self.controller.close()
+
+    def is_imported(self, filepath):
+        stat = os.stat(filepath)
+        record = self.imports.find_one({"_id": filepath})
+        return record is not None and record[ "size" ] == stat.st_size and record[ "mtime" ] == stat.st_mtime
+
+    def import_files(self, filepaths):
+        filepaths = [ os.path.realpath(p) for p in filepaths ]
+        todo = [ p for p in filepaths if self.recreate or not self.is_imported(p) ]
+        reports = [ dict(filepath=p, status="skipped") for p in filepaths if p not in todo ]
+        self.logger.info("Importing {} Torque file(s), {} already imported".format(len(todo), len(reports)))
+        if not todo:
+            return reports
+
+        # spawned, not forked: this process already runs the geocoding and flusher threads
+        # and holds the MongoClient
+        # parsed arrays wait in the parent until stored, so only a sliding window of files is
+        # submitted ahead of the slower store() instead of the whole list
+        window = 2 * (self.processes or os.cpu_count() or 1)
+        pending = collections.deque()
+        queued = iter(todo)
+        with multiprocessing.get_context("spawn").Pool(self.processes) as pool:
+            for filepath in itertools.islice(queued, window):
+                pending.append(pool.apply_async(parse_torque_file, (filepath,)))
+            while pending:
+                filepath, start_date, array, parse_duration = pending.popleft().get()
+                for next_filepath in itertools.islice(queued, 1):
+                    pending.append(pool.apply_async(parse_torque_file, (next_filepath,)))
+                if array is None:
+                    self.logger.error("Unable to parse '{}'".format(filepath))
+                    reports.append(dict(filepath=filepath, status="failed"))
+                    continue
+
+                report = self.store(filepath, start_date, array)
+                report[ "parse_duration" ] = parse_duration
+                report[ "parse_rows_per_second" ] = len(array) / parse_duration if parse_duration else 0.0
+                reports.append(report)
+                self.logger.info("Imported '{}': {} rows, parsed at {} rows/s, stored at {} rows/s".format(
+                    filepath, report[ "rows" ], int(report[ "parse_rows_per_second" ]),
+                    int(report[ "store_rows_per_second" ])))
+        return reports
+
+    def store(self, filepath, start_date, array):
+        start = time.monotonic()
+        session = self.controller.recreate(filepath)
+        session.start(start_date)
+
+        fields = [ f for f in array.dtype.names if f in CarSession.DATA_VALID_FIELDS ]
+        columns = { f: array[ f ].tolist() for f in fields }
+        latitudes = columns.pop("latitude")
+        longitudes = columns.pop("longitude")
+        for i in range(len(latitudes)):
+            session.new_car_data(latitudes[ i ], longitudes[ i ], **{ f: columns[ f ][ i ] for f in columns })
+        session.stop()
+
+        stat = os.stat(filepath)
+        self.imports.replace_one({"_id": filepath},
+                                 dict(size=stat.st_size, mtime=stat.st_mtime, rows=len(array),
+                                      session_uid=session.uid, imported_at=datetime.datetime.now()),
+                                 upsert=True)
+
+        duration = time.monotonic() - start
+        return dict(filepath=filepath,
+                    status="imported",
+                    session_uid=session.uid,
+                    rows=len(array),
+                    store_duration=duration,
+                    store_rows_per_second=len(array) / duration if duration else 0.0)
+
+
+def find_torque_files(paths):
+    filepaths = []
+    for path in paths:
+        if os.path.isdir(path):
+            filepaths.extend(sorted(glob.glob(os.path.join(path, "*.csv"))))
+        else:
+            filepaths.append(path)
+    return filepaths
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Import Torque CSV logs into the car database")
+    parser.add_argument("--db-path", default="mongodb://localhost:27017/")
+    parser.add_argument("--db-name", default="autopial-cardb")
+    parser.add_argument("--storage", default="document", choices=("document", "bucket"))
+    parser.add_argument("--processes", type=int, default=None, help="parsing processes, one per CPU by default")
+    parser.add_argument("--recreate", action="store_true", help="re-import files already imported")
+    parser.add_argument("paths", nargs="+", help="Torque CSV files or folders containing them")
+    args = parser.parse_args()
+
+    driver = CarDriver(args.db_path, args.db_name, buffered=True, buffer_size=2000, storage=args.storage)
+    importer = TorqueImporter(driver, processes=args.processes, recreate=args.recreate)
+    for report in importer.import_files(find_torque_files(args.paths)):
+        if report[ "status" ] == "imported":
+            print("{filepath}: {rows} rows, parse {parse_rows_per_second:.0f} rows/s, "
+                  "store {store_rows_per_second:.0f} rows/s".format(**report))
+        else:
+            print("{filepath}: {status}".format(**report))
+    importer.close()
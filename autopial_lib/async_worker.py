@@ -0,0 +1,137 @@
+import asyncio
+import concurrent.futures
+import logging
+import sys
+import time
+
+import paho.mqtt.client as mqtt
+
+from autopial_lib.thread_worker import AutopialPublisher, AutopialWorker, shared_mqtt_client
+
+
+class AsyncAutopialWorker(AutopialPublisher):
+    """Worker running as a coroutine of an AutopialScheduler, publishing on its shared MQTT connection.
+
+    Subclasses implement 'async def run(self)' with the same loop as AutopialWorker:
+
+        while await self.wait():
+            self.publish("autopial/topic", value)
+    """
+
+    def __init__(self, mqtt_client_name, time_sleep=5, logger=None, serializer="json"):
+        AutopialPublisher.__init__(self, mqtt_client_name, time_sleep=time_sleep, logger=logger,
+                                   serializer=serializer)
+        self.logger.info("New AsyncAutopialWorker: '{}' publishing every {}secs".format(mqtt_client_name, time_sleep))
+        self._stopevent = None
+
+    def attach(self, mqtt_client):
+        # called by the scheduler from its event loop
+        self.mqtt_client = mqtt_client
+        self._stopevent = asyncio.Event()
+
+    async def run(self):
+        self.logger.error("Define a run() method from an inherited class of AsyncAutopialWorker")
+
+    async def wait(self):
+        if self._one_time_force == True:
+            self._one_time_force = False
+        else:
+            self.logger.debug("{} sleeping for {} seconds".format(self.client_name, self.time_sleep))
+            end = time.monotonic() + self.time_sleep
+            while not self._stopevent.is_set():
+                timeout = self._wait_timeout(end)
+                if timeout is None:
+                    break
+                try:
+                    await asyncio.wait_for(self._stopevent.wait(), timeout)
+                    break
+                except asyncio.TimeoutError:
+                    self.publish_pending()
+        return not self._stopevent.is_set()
+
+    def next(self):
+        return not self._stopevent.is_set()
+
+    def stop(self):
+        self._stopevent.set()
+
+
+class AutopialScheduler():
+    """Runs many workers in one process over a single MQTT connection.
+
+    AsyncAutopialWorker instances run as tasks of one asyncio event loop. Existing
+    AutopialWorker subclasses added with add_worker_class() keep their blocking
+    run()/wait()/publish() and run in a thread each, but share the same connection.
+    """
+    BROKER_ADDRESS = AutopialWorker.BROKER_ADDRESS
+
+    def __init__(self, mqtt_client_name, logger=None):
+        if logger is None:
+            self.logger = logging.getLogger(__name__)
+        else:
+            self.logger = logger
+
+        self.client_name = mqtt_client_name
+        self.workers = []
+        self.legacy_workers = []
+        self._loop = None
+        self.mqtt_connect()
+
+    def mqtt_connect(self):
+        self.logger.info("Connection to MQTT broker: '{}' with name '{}'".format(self.BROKER_ADDRESS, self.client_name))
+        self.mqtt_client = mqtt.Client(self.client_name)
+        try:
+            self.mqtt_client.connect(self.BROKER_ADDRESS, port=1883, keepalive=60)
+        except ConnectionRefusedError as e:
+            self.logger.error("  => MQTT connection failed ! Is broker installed and launched ? (sudo apt install mosquitto")
+            sys.exit(1)
+        # network traffic and keepalive are handled by paho's own thread, publish() is thread safe
+        self.mqtt_client.loop_start()
+        self.logger.info("  => successful !")
+
+    def add(self, worker):
+        self.workers.append(worker)
+        return worker
+
+    def add_worker_class(self, worker_class, *args, **kwargs):
+        # compatibility shim for AutopialWorker subclasses, constructed unchanged: their
+        # AutopialWorker.__init__ picks the shared client up instead of connecting
+        with shared_mqtt_client(self.mqtt_client):
+            worker = worker_class(*args, **kwargs)
+        self.legacy_workers.append(worker)
+        return worker
+
+    async def run_async(self):
+        self._loop = asyncio.get_running_loop()
+        for worker in self.workers:
+            worker.attach(self.mqtt_client)
+
+        tasks = [ asyncio.ensure_future(worker.run()) for worker in self.workers ]
+        executor = None
+        if self.legacy_workers:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.legacy_workers))
+            tasks += [ self._loop.run_in_executor(executor, worker.run) for worker in self.legacy_workers ]
+
+        try:
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            for result in results:
+                if isinstance(result, BaseException):
+                    self.logger.error("Worker terminated with an error: {}".format(repr(result)))
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+    def run(self):
+        try:
+            asyncio.run(self.run_async())
+        finally:
+            self.mqtt_client.loop_stop()
+            self.mqtt_client.disconnect()
+
+    def stop(self):
+        # may be called from any thread, e.g. a signal handler
+        for worker in self.legacy_workers:
+            worker.stop()
+        if self._loop is not None:
+            for worker in self.workers:
+                self._loop.call_soon_threadsafe(worker.stop)
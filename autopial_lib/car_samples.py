@@ -0,0 +1,121 @@
+from array import array
+from collections.abc import Mapping, Sequence
+
+CAR_DATA_FIELDS = ("timestamp", "distance",
+                   "fix", "latitude", "longitude", "altitude",
+                   "gps_speed", "direction",
+                   "obd_speed", "rpm", "coolant_temp", "oil_temp",
+                   "accel_x", "accel_y", "accel_z")
+
+# stored as signed chars and read back as bool, every other field is a double
+BOOL_FIELDS = ("fix",)
+
+NAN = float("nan")
+
+
+class CarSample(Mapping):
+    """Read-only dict-like view of one row of a CarSamples container."""
+    __slots__ = ("_samples", "_index")
+
+    def __init__(self, samples, index):
+        self._samples = samples
+        self._index = index
+
+    def __getitem__(self, key):
+        column = self._samples._columns.get(key)
+        if column is not None:
+            value = column[ self._index ]
+            return bool(value) if key in BOOL_FIELDS else value
+        if key == "session_uid" and self._samples.session_uid is not None:
+            return self._samples.session_uid
+        raise KeyError(key)
+
+    def __iter__(self):
+        yield from self._samples._columns
+        if self._samples.session_uid is not None:
+            yield "session_uid"
+
+    def __len__(self):
+        return len(self._samples._columns) + (self._samples.session_uid is not None)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class CarSamples(Sequence):
+    """Car data samples of a session stored as one array per field.
+
+    About 8 bytes per field and sample instead of a dict of Python floats per sample.
+    Indexing returns CarSample views that behave like the car data dicts, slicing
+    returns a new CarSamples and column() exposes the raw arrays (numpy.frombuffer
+    wraps them without copy). Missing values are stored as NaN.
+    """
+
+    def __init__(self, fields=CAR_DATA_FIELDS, session_uid=None):
+        self.session_uid = session_uid
+        self._columns = { f: array('b' if f in BOOL_FIELDS else 'd') for f in fields }
+
+    @classmethod
+    def from_rows(cls, rows, fields=CAR_DATA_FIELDS, session_uid=None):
+        samples = cls(fields, session_uid)
+        samples.extend(rows)
+        return samples
+
+    @classmethod
+    def from_columns(cls, columns, session_uid=None):
+        # columns: field -> sequence or numpy array of the same length
+        samples = cls(list(columns), session_uid)
+        for field, values in columns.items():
+            column = samples._columns[ field ]
+            if hasattr(values, "astype"):
+                dtype = 'i1' if column.typecode == 'b' else '<f8'
+                column.frombytes(values.astype(dtype).tobytes())
+            else:
+                column.extend(values)
+        return samples
+
+    @property
+    def fields(self):
+        return tuple(self._columns)
+
+    @property
+    def nbytes(self):
+        return sum(c.itemsize * len(c) for c in self._columns.values())
+
+    def column(self, field):
+        return self._columns[ field ]
+
+    def append(self, car_data):
+        if self.session_uid is None:
+            self.session_uid = car_data.get("session_uid")
+        for field, column in self._columns.items():
+            value = car_data.get(field)
+            column.append(NAN if value is None and column.typecode == 'd' else value or 0)
+
+    def extend(self, rows):
+        for car_data in rows:
+            self.append(car_data)
+
+    def __len__(self):
+        for column in self._columns.values():
+            return len(column)
+        return 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            samples = CarSamples((), self.session_uid)
+            samples._columns = { f: c[ index ] for f, c in self._columns.items() }
+            return samples
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("car sample index out of range")
+        return CarSample(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield CarSample(self, index)
+
+    def to_dicts(self):
+        # plain JSON-ready dicts, missing values (NaN) back to None
+        return [ { key: None if value != value else value for key, value in sample.items() } for sample in self ]
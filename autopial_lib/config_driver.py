@@ -1,10 +1,46 @@
 import logging
+import threading
 
 import sys
 import yaml
 import os
 
+# LibYAML bindings when PyYAML was built with them, pure Python loader otherwise
+YAML_LOADER = getattr(yaml, "CFullLoader", yaml.FullLoader)
+
+# marks the key paths leading to a mapping, see flatten()
+BRANCH = object()
+MISSING = object()
+
+
+def flatten(cfg, path=(), values=None):
+    # key path tuple -> value for every node of the config; mappings are stored as BRANCH,
+    # lists both as a whole and item by item
+    if values is None:
+        values = {}
+    if isinstance(cfg, dict):
+        if path:
+            values[ path ] = BRANCH
+        for key, value in cfg.items():
+            flatten(value, path + (key,), values)
+    else:
+        values[ path ] = cfg
+        if isinstance(cfg, list):
+            for index, value in enumerate(cfg):
+                flatten(value, path + (index,), values)
+    return values
+
+
 class ConfigFile():
+    """YAML config file flattened into a key path -> value map.
+
+    With watch(), the file is reloaded in the background when its modification time
+    changes and the callbacks registered with on_change() are called, e.g. to let a
+    worker adjust its publishing interval without restart:
+
+        config.on_change(lambda value: setattr(worker, "time_sleep", value), "gps", "time_sleep")
+    """
+
     def __init__(self, filename, look_in_folders=["/etc/autopial/", "./"], logger=None):
         self._config_loaded = False
         if logger is None:
@@ -12,6 +48,10 @@ class ConfigFile():
         else:
             self.logger = logger
 
+        self._values = {}
+        self._callbacks = []
+        self._watcher = None
+        self._stopevent = threading.Event()
         self.load(filename, look_in_folders)
 
     def look_in_folder(self, ordered_folders):
@@ -38,29 +78,84 @@ class ConfigFile():
             sys.exit(1)
 
         self.logger.info("Loading config file: '{}'".format(configfile))
+        self._configfile = configfile
+        self._mtime = self._file_stamp()
         with open(configfile, 'r') as ymlfile:
-            self._cfg = yaml.load(ymlfile, Loader=yaml.FullLoader)
+            self._cfg = yaml.load(ymlfile, Loader=YAML_LOADER)
+        self._values = flatten(self._cfg)
         return True
 
     def get(self, *kargs, default=None):
-        v = self._cfg
-        for key in kargs:
-            try:
-                v = v[key]
-            except TypeError:
-                if default is None:
-                    raise BaseException("Key path '{}' not found".format(":".join(kargs)))
-                else:
-                    return default
-            except KeyError:
-                if default is None:
-                    raise BaseException("Key path '{}' not found".format(":".join(kargs)))
-                else:
-                    return default
-        if isinstance(v, dict):
-            if default is None:
-                raise BaseException("Key path '{}' is incomplete. Please provide an additional key".format(":".join(kargs)))
-            else:
+        v = self._values.get(kargs, MISSING)
+        if v is MISSING or v is BRANCH:
+            if default is not None:
                 return default
-        self.logger.debug("Config: {} = {}".format(kargs, v))
-        return v
\ No newline at end of file
+            if v is MISSING:
+                raise BaseException("Key path '{}' not found".format(":".join(map(str, kargs))))
+            raise BaseException("Key path '{}' is incomplete. Please provide an additional key".format(":".join(map(str, kargs))))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Config: {} = {}".format(kargs, v))
+        return v
+
+    def _file_stamp(self):
+        stat = os.stat(self._configfile)
+        return stat.st_mtime_ns, stat.st_size
+
+    def on_change(self, callback, *kargs):
+        """Calls callback(value) when the value at key path kargs changes on reload, or
+        callback(changed_paths) on any change when no key path is given."""
+        self._callbacks.append((kargs, callback))
+
+    def reload(self):
+        # re-reads the file, keeping the current config if it is invalid; returns the changed key paths
+        try:
+            self._mtime = self._file_stamp()
+            with open(self._configfile, 'r') as ymlfile:
+                cfg = yaml.load(ymlfile, Loader=YAML_LOADER)
+        except (OSError, yaml.YAMLError) as e:
+            self.logger.error("Unable to reload config file '{}': {}".format(self._configfile, e))
+            return set()
+
+        values = flatten(cfg)
+        old_values = self._values
+        changed = { path for path in values.keys() | old_values.keys()
+                    if values.get(path, MISSING) != old_values.get(path, MISSING) }
+        self._cfg = cfg
+        self._values = values
+        if not changed:
+            return changed
+
+        self.logger.info("Config file '{}' reloaded, {} value(s) changed".format(self._configfile, len(changed)))
+        for path, callback in self._callbacks:
+            if path and path not in changed:
+                continue
+            try:
+                callback(self._values.get(path) if path else changed)
+            except Exception as e:
+                self.logger.error("Config change callback {} failed: {}".format(callback, e))
+        return changed
+
+    def watch(self, interval=2.0):
+        # polls the modification time of the file from a daemon thread
+        if self._watcher is not None:
+            return
+        self._stopevent.clear()
+        self._watcher = threading.Thread(target=self._watch, args=(interval,), name="config-watcher")
+        self._watcher.daemon = True
+        self._watcher.start()
+
+    def _watch(self, interval):
+        while not self._stopevent.wait(interval):
+            try:
+                mtime = self._file_stamp()
+            except OSError:
+                # being replaced by an editor, try again on the next poll
+                continue
+            if mtime != self._mtime:
+                self.reload()
+
+    def stop_watching(self):
+        self._stopevent.set()
+        if self._watcher is not None:
+            self._watcher.join()
+            self._watcher = None
\ No newline at end of file
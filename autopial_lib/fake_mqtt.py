@@ -0,0 +1,125 @@
+import threading
+
+
+def topic_matches(subscription, topic):
+    # MQTT wildcard matching: '+' one level, '#' all remaining levels
+    sub_levels = subscription.split("/")
+    topic_levels = topic.split("/")
+    for i, level in enumerate(sub_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[ i ]:
+            return False
+    return len(sub_levels) == len(topic_levels)
+
+
+class FakeMessage():
+    def __init__(self, topic, payload, qos=0, retain=False):
+        self.topic = topic
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+
+
+class FakeBroker():
+    """In-process MQTT broker for tests and benchmarks, delivering messages synchronously."""
+
+    def __init__(self):
+        self.clients = []
+        self.retained = {}
+        self.published = 0
+        self._lock = threading.Lock()
+
+    def client(self, client_id=""):
+        return FakeMQTTClient(client_id, broker=self)
+
+    def deliver(self, message):
+        with self._lock:
+            self.published += 1
+            if message.retain:
+                self.retained[ message.topic ] = message
+            clients = list(self.clients)
+        for client in clients:
+            client._deliver(message)
+
+    def connect(self, client):
+        with self._lock:
+            if client not in self.clients:
+                self.clients.append(client)
+
+    def disconnect(self, client):
+        with self._lock:
+            if client in self.clients:
+                self.clients.remove(client)
+
+
+class FakeMQTTClient():
+    """Subset of paho.mqtt.client.Client used by the autopial workers and bridges."""
+
+    def __init__(self, client_id="", broker=None):
+        self.client_id = client_id
+        self.broker = broker if broker is not None else FakeBroker()
+        self.subscriptions = []
+        self.connected = False
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.userdata = None
+
+    def connect(self, host="localhost", port=1883, keepalive=60):
+        self.broker.connect(self)
+        self.connected = True
+        if self.on_connect is not None:
+            self.on_connect(self, self.userdata, {}, 0)
+        return 0
+
+    def connect_async(self, host="localhost", port=1883, keepalive=60):
+        return self.connect(host, port, keepalive)
+
+    def reconnect(self):
+        return self.connect()
+
+    def disconnect(self):
+        self.broker.disconnect(self)
+        self.connected = False
+        if self.on_disconnect is not None:
+            self.on_disconnect(self, self.userdata, 0)
+        return 0
+
+    def is_connected(self):
+        return self.connected
+
+    def subscribe(self, topic, qos=0):
+        self.subscriptions.append(topic)
+        for message in list(self.broker.retained.values()):
+            if topic_matches(topic, message.topic):
+                self._deliver(message)
+        return 0, len(self.subscriptions)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if not self.connected:
+            # MQTT_ERR_NO_CONN
+            return FakePublishInfo(4)
+        self.broker.deliver(FakeMessage(topic, payload, qos, retain))
+        return FakePublishInfo(0)
+
+    def loop_start(self):
+        return 0
+
+    def loop_stop(self):
+        return 0
+
+    def _deliver(self, message):
+        if self.on_message is None:
+            return
+        if any(topic_matches(s, message.topic) for s in self.subscriptions):
+            self.on_message(self, self.userdata, message)
+
+
+class FakePublishInfo():
+    def __init__(self, rc):
+        self.rc = rc
@@ -0,0 +1,166 @@
+import bisect
+import os
+import threading
+import time
+
+# latency histogram upper bounds, in seconds
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram():
+    __slots__ = ("buckets", "counts", "count", "sum", "max", "_lock")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # one more slot for the values above the last bound
+        self.counts = [ 0 ] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[ index ] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q quantile, max for the last bucket
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.buckets[ index ] if index < len(self.buckets) else self.max
+        return self.max
+
+    def snapshot(self):
+        return dict(count=self.count, sum=self.sum, max=self.max,
+                    avg=self.sum / self.count if self.count else None,
+                    p50=self.quantile(0.5), p99=self.quantile(0.99))
+
+
+class _Timer():
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class _NoopTimer():
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NOOP_TIMER = _NoopTimer()
+
+
+class Metrics():
+    """Process wide counters and latency histograms.
+
+    Disabled by default, or enabled with AUTOPIAL_METRICS=1. While disabled, timer()
+    returns a shared no-op context manager and count() returns immediately, so the
+    instrumented hot paths only pay for one attribute test.
+
+        with metrics.timer("car_driver.flush"):
+            ...
+        metrics.count("car_driver.flushed_samples", len(samples))
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+            self.started = time.time()
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        return histogram
+
+    def timer(self, name):
+        if not self.enabled:
+            return NOOP_TIMER
+        return _Timer(self.histogram(name))
+
+    def observe(self, name, value):
+        if self.enabled:
+            self.histogram(name).observe(value)
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[ name ] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        return dict(uptime=time.time() - self.started,
+                    counters=dict(self.counters),
+                    timers={ name: h.snapshot() for name, h in list(self.histograms.items()) })
+
+    def to_prometheus(self, prefix="autopial"):
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            metric = _metric_name(prefix, name) + "_total"
+            lines.append("# TYPE {} counter".format(metric))
+            lines.append("{} {}".format(metric, value))
+
+        for name, histogram in sorted(self.histograms.items()):
+            metric = _metric_name(prefix, name) + "_seconds"
+            lines.append("# TYPE {} histogram".format(metric))
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append('{}_bucket{{le="{}"}} {}'.format(metric, bound, cumulative))
+            lines.append('{}_bucket{{le="+Inf"}} {}'.format(metric, histogram.count))
+            lines.append("{}_sum {}".format(metric, histogram.sum))
+            lines.append("{}_count {}".format(metric, histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, filepath, prefix="autopial"):
+        # for the node_exporter textfile collector, which must never see a partial file
+        with open(filepath + ".tmp", 'w') as f:
+            f.write(self.to_prometheus(prefix))
+        os.replace(filepath + ".tmp", filepath)
+
+
+def _metric_name(prefix, name):
+    return "{}_{}".format(prefix, "".join(c if c.isalnum() else "_" for c in name))
+
+
+metrics = Metrics(enabled=os.environ.get("AUTOPIAL_METRICS", "0") not in ("", "0"))
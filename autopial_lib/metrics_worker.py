@@ -0,0 +1,32 @@
+from autopial_lib.metrics import metrics
+from autopial_lib.thread_worker import AutopialWorker
+
+
+class MetricsWorker(AutopialWorker):
+    """Publishes the metrics of its process on 'autopial/metrics/<worker name>' every time_sleep
+    seconds and, with prometheus_path, writes them for the node_exporter textfile collector.
+
+    Enables the metrics registry it exports.
+    """
+
+    def __init__(self, mqtt_client_name="metrics", time_sleep=30, logger=None, prometheus_path=None,
+                 registry=None, **kwargs):
+        AutopialWorker.__init__(self, mqtt_client_name, time_sleep=time_sleep, logger=logger, **kwargs)
+        self.registry = metrics if registry is None else registry
+        self.registry.enable()
+        self.prometheus_path = prometheus_path
+        self.topic = "autopial/metrics/{}".format(mqtt_client_name)
+
+    def export(self):
+        self.publish(self.topic, self.registry.snapshot(), ignore_timer=True)
+        if self.prometheus_path is not None:
+            try:
+                self.registry.write_prometheus(self.prometheus_path)
+            except OSError as e:
+                self.logger.error("Unable to write metrics to '{}': {}".format(self.prometheus_path, e))
+
+    def run(self):
+        while self.wait():
+            self.export()
+        # last values before exiting
+        self.export()
@@ -0,0 +1,255 @@
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+# magic, version, capacity, head, tail, count, evicted
+HEADER = struct.Struct("<8sIQQQQQ")
+HEADER_SIZE = mmap.PAGESIZE
+MAGIC = b"APSPOOL1"
+VERSION = 1
+
+# payload length, crc32, topic length, flags
+RECORD = struct.Struct("<IIHB")
+WRAP = 0xFFFFFFFF
+FLAG_RETAIN = 1
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+EVICTION_POLICIES = (DROP_OLDEST, DROP_NEWEST)
+
+
+class MQTTSpool():
+    """Store-and-forward spool of MQTT publishes in a memory-mapped ring buffer file.
+
+    Records are appended at the tail and replayed in order from the head. When the
+    'capacity' bytes are used, 'drop_oldest' evicts the oldest records to make room and
+    'drop_newest' rejects the new one. Writes only touch the page cache: the dirty pages
+    are msync'ed every 'sync_interval' seconds or 'sync_bytes' written, whichever comes
+    first, so an SD card sees one write per page and sync rather than one per message.
+    Each record carries a CRC so a torn write after a power loss ends the replay instead
+    of sending garbage.
+    """
+
+    def __init__(self, filepath, capacity=4 * 1024 * 1024, policy=DROP_OLDEST,
+                 sync_interval=5.0, sync_bytes=64 * 1024, logger=None):
+        if logger is None:
+            self.logger = logging.getLogger(__name__)
+        else:
+            self.logger = logger
+
+        if policy not in EVICTION_POLICIES:
+            raise ValueError("Unknown spool eviction policy '{}', expected one of {}".format(policy, EVICTION_POLICIES))
+
+        self.filepath = filepath
+        self.policy = policy
+        self.sync_interval = sync_interval
+        self.sync_bytes = sync_bytes
+        self._lock = threading.RLock()
+        self._dirty_start = None
+        self._dirty_end = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._open(capacity)
+
+    def _open(self, capacity):
+        exists = os.path.exists(self.filepath) and os.path.getsize(self.filepath) > HEADER_SIZE
+        fd = os.open(self.filepath, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if exists:
+                magic, version, file_capacity, head, tail, count, evicted = \
+                    HEADER.unpack(os.pread(fd, HEADER.size, 0))
+                if magic != MAGIC or version != VERSION or \
+                        os.path.getsize(self.filepath) != HEADER_SIZE + file_capacity:
+                    self.logger.warning("Spool '{}' is invalid, starting a new one".format(self.filepath))
+                    exists = False
+                else:
+                    # the capacity of an existing spool wins over the requested one
+                    capacity = file_capacity
+            if not exists:
+                head, tail, count, evicted = 0, 0, 0, 0
+                os.ftruncate(fd, HEADER_SIZE + capacity)
+            self._mmap = mmap.mmap(fd, HEADER_SIZE + capacity)
+        finally:
+            os.close(fd)
+
+        self.capacity = capacity
+        self.head = head
+        self.tail = tail
+        self.count = count
+        self.evicted = evicted
+        self._write_header()
+        if count:
+            self.logger.info("Spool '{}' holds {} message(s) to replay".format(self.filepath, count))
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def used(self):
+        if self.count == 0:
+            return 0
+        if self.tail > self.head:
+            return self.tail - self.head
+        return self.capacity - self.head + self.tail
+
+    def _write_header(self):
+        HEADER.pack_into(self._mmap, 0, MAGIC, VERSION, self.capacity, self.head, self.tail, self.count, self.evicted)
+        self._touch(0, HEADER.size)
+
+    def _touch(self, offset, size):
+        if self._dirty_start is None or offset < self._dirty_start:
+            self._dirty_start = offset
+        if self._dirty_end is None or offset + size > self._dirty_end:
+            self._dirty_end = offset + size
+
+    def _free_at_tail(self, size):
+        # offset (in the data area) where a record of 'size' bytes can be written, None if it does not fit
+        if self.count == 0:
+            self.head = self.tail = 0
+            return 0
+        if self.tail > self.head:
+            if self.capacity - self.tail >= size:
+                return self.tail
+            return 0 if self.head >= size else None
+        return self.tail if self.head - self.tail >= size else None
+
+    def append(self, topic, payload, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        topic = topic.encode('utf-8')
+        size = RECORD.size + len(topic) + len(payload)
+        if size > self.capacity:
+            self.logger.error("Message on '{}' is larger than the spool, dropped".format(topic))
+            return False
+
+        with self._lock:
+            offset = self._free_at_tail(size)
+            while offset is None:
+                if self.policy == DROP_NEWEST:
+                    self.evicted += 1
+                    return False
+                self._pop()
+                self.evicted += 1
+                offset = self._free_at_tail(size)
+
+            if offset < self.tail:
+                # not enough room before the end of the file: mark the wrap and start over at 0
+                if self.capacity - self.tail >= 4:
+                    struct.pack_into("<I", self._mmap, HEADER_SIZE + self.tail, WRAP)
+                    self._touch(HEADER_SIZE + self.tail, 4)
+
+            position = HEADER_SIZE + offset
+            crc = zlib.crc32(payload, zlib.crc32(topic))
+            RECORD.pack_into(self._mmap, position, len(payload), crc, len(topic), FLAG_RETAIN if retain else 0)
+            start = position + RECORD.size
+            self._mmap[ start:start + len(topic) ] = topic
+            self._mmap[ start + len(topic):start + len(topic) + len(payload) ] = payload
+            self._touch(position, size)
+            self._unsynced += size
+
+            self.tail = offset + size
+            self.count += 1
+            self._write_header()
+            self._maybe_sync()
+        return True
+
+    def _read(self, offset):
+        # (record, offset of the next record) for the record at 'offset' of the data area
+        if self.capacity - offset < 4 or \
+                struct.unpack_from("<I", self._mmap, HEADER_SIZE + offset)[ 0 ] == WRAP:
+            offset = 0
+        position = HEADER_SIZE + offset
+        length, crc, topic_length, flags = RECORD.unpack_from(self._mmap, position)
+        start = position + RECORD.size
+        topic = bytes(self._mmap[ start:start + topic_length ])
+        payload = bytes(self._mmap[ start + topic_length:start + topic_length + length ])
+        if zlib.crc32(payload, zlib.crc32(topic)) != crc:
+            raise ValueError("corrupted record at offset {}".format(offset))
+        return (topic.decode('utf-8'), payload, bool(flags & FLAG_RETAIN)), offset + RECORD.size + topic_length + length
+
+    def _pop(self):
+        record, self.head = self._read(self.head)
+        self.count -= 1
+        if self.count == 0:
+            self.head = self.tail = 0
+        return record
+
+    def peek(self, limit):
+        # up to 'limit' records from the head, left in the spool until commit()
+        records = []
+        with self._lock:
+            offset = self.head
+            try:
+                for i in range(min(limit, self.count)):
+                    record, offset = self._read(offset)
+                    records.append(record)
+            except ValueError as e:
+                self.logger.error("Spool '{}': {}, dropping the {} remaining message(s)".format(
+                    self.filepath, e, self.count - len(records)))
+                self.evicted += self.count - len(records)
+                self.count = len(records)
+                self.tail = offset
+                self._write_header()
+        return records
+
+    def commit(self, nbr_records):
+        with self._lock:
+            for i in range(min(nbr_records, self.count)):
+                self._pop()
+            self._write_header()
+            self._maybe_sync()
+
+    def replay(self, publish, batch_size=100):
+        """Sends the spooled records in order with publish(topic, payload, retain), which returns
+        False when the link is down again. Returns the number of records sent."""
+        sent = 0
+        with self._lock:
+            while self.count:
+                records = self.peek(batch_size)
+                done = 0
+                for topic, payload, retain in records:
+                    if not publish(topic, payload, retain):
+                        break
+                    done += 1
+                self.commit(done)
+                sent += done
+                if done < len(records):
+                    break
+        return sent
+
+    def send(self, publish, topic, payload, retain=False):
+        # publishes directly when nothing is spooled and the link is up, spools otherwise
+        with self._lock:
+            if self.count:
+                self.replay(publish)
+            if self.count or not publish(topic, payload, retain):
+                # spooled messages go first to keep the order, this one waits behind them
+                return self.append(topic, payload, retain)
+        return True
+
+    def _maybe_sync(self):
+        if self._dirty_start is None:
+            return
+        if self._unsynced >= self.sync_bytes or \
+                time.monotonic() - self._last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        with self._lock:
+            if self._dirty_start is not None:
+                start = self._dirty_start - self._dirty_start % mmap.PAGESIZE
+                self._mmap.flush(start, self._dirty_end - start)
+                if start > 0:
+                    self._mmap.flush(0, HEADER_SIZE)
+            self._dirty_start = self._dirty_end = None
+            self._unsynced = 0
+            self._last_sync = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            self.sync()
+            self._mmap.close()
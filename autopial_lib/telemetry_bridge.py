@@ -0,0 +1,253 @@
+import datetime
+import json
+import logging
+import math
+import queue
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from autopial_lib.Controller.CarController import CarSession
+from autopial_lib.thread_worker import AutopialWorker
+
+
+class TelemetryBridge():
+    """Stores car data published on MQTT into car sessions.
+
+    Messages feed the session of their device (payload 'autopial.device_uid'). Dict payloads
+    are mapped key by key with FIELD_MAP, scalar payloads ({"value": ...} as published by
+    AutopialWorker) with topic_fields. The last known value of every field is kept per device
+    and one sample carrying all of them is stored on each GPS fix, or every 'sample_interval'
+    seconds while only other channels are received, at the last known position.
+    Messages go through a bounded queue: when the database falls behind, the MQTT network
+    thread blocks on it and the broker buffers the messages. A writer thread stores them in
+    batches and records the lag between the message 'datetime' and its commit.
+    """
+    TOPICS = [ "autopial/car/#" ]
+
+    FIELD_MAP = dict({ f: f for f in CarSession.DATA_VALID_FIELDS },
+                     lat="latitude", lon="longitude", alt="altitude", speed="gps_speed", bearing="direction")
+
+    def __init__(self, controller, db_driver, mqtt_client=None, topics=None, topic_fields=None,
+                 queue_size=10000, batch_size=500, batch_max_age=1.0, session_timeout=600, sample_interval=1.0,
+                 logger=None):
+        if logger is None:
+            self.logger = logging.getLogger(__name__)
+        else:
+            self.logger = logger
+
+        self.controller = controller
+        self.db_driver = db_driver
+        self.topics = self.TOPICS if topics is None else topics
+        self.topic_fields = {} if topic_fields is None else topic_fields
+        self.batch_size = batch_size
+        self.batch_max_age = batch_max_age
+        self.session_timeout = session_timeout
+        self.sample_interval = sample_interval
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stopevent = threading.Event()
+        self._sessions = {}
+        # device uid -> last known value of each field, date of the last stored sample
+        self._latest = {}
+        self._last_sample = {}
+        self._writer = None
+
+        self.received = 0
+        self.committed = 0
+        self.rejected = 0
+        self.failed = 0
+        self.samples = 0
+        self.blocked_duration = 0.0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+
+        if mqtt_client is None:
+            mqtt_client = mqtt.Client("autopial-telemetry-bridge")
+            self.mqtt_client = mqtt_client
+            mqtt_client.on_connect = self._on_connect
+            mqtt_client.on_message = self._on_message
+            mqtt_client.connect(AutopialWorker.BROKER_ADDRESS, port=1883, keepalive=60)
+        else:
+            self.mqtt_client = mqtt_client
+            mqtt_client.on_connect = self._on_connect
+            mqtt_client.on_message = self._on_message
+            self._subscribe()
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        return dict(received=self.received,
+                    committed=self.committed,
+                    rejected=self.rejected,
+                    failed=self.failed,
+                    samples=self.samples,
+                    queue_depth=self.queue_depth,
+                    blocked_duration=self.blocked_duration,
+                    last_lag=self.last_lag,
+                    max_lag=self.max_lag,
+                    avg_lag=self.total_lag / self.committed if self.committed else 0.0)
+
+    def _subscribe(self):
+        for topic in self.topics:
+            self.mqtt_client.subscribe(topic)
+
+    def _on_connect(self, client, userdata, flags, rc):
+        self._subscribe()
+
+    def _on_message(self, client, userdata, message):
+        try:
+            payload = json.loads(message.payload)
+            item = self.parse_message(message.topic, payload)
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            self.rejected += 1
+            self.logger.warning("Invalid telemetry on '{}': {}".format(message.topic, e))
+            return
+        if item is None:
+            return
+
+        self.received += 1
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            # backpressure: hold the network thread until the writer catches up
+            start = time.monotonic()
+            self._queue.put(item)
+            self.blocked_duration += time.monotonic() - start
+
+    def parse_message(self, topic, payload):
+        # (device uid, message datetime, new_car_data fields) or None to ignore the message
+        if not isinstance(payload, dict):
+            return None
+
+        fields = {}
+        if "value" in payload and topic in self.topic_fields:
+            fields[ self.topic_fields[ topic ] ] = self._coerce(self.topic_fields[ topic ], payload[ "value" ])
+        for key, value in payload.items():
+            field = self.FIELD_MAP.get(key)
+            if field is not None:
+                fields[ field ] = self._coerce(field, value)
+        if not fields:
+            return None
+
+        if "datetime" in payload:
+            date = datetime.datetime.fromisoformat(payload[ "datetime" ])
+            if date.tzinfo is not None:
+                # sessions and lags are computed on naive local datetimes
+                date = date.astimezone().replace(tzinfo=None)
+        else:
+            date = datetime.datetime.now()
+        device_uid = str(payload.get("autopial", {}).get("device_uid", "unknown"))
+        return device_uid, date, fields
+
+    @staticmethod
+    def _coerce(field, value):
+        # float value of a field, ValueError/TypeError for values new_car_data() cannot store
+        if field == "fix":
+            return bool(value)
+        value = float(value)
+        if not math.isfinite(value):
+            raise ValueError("{} is not a finite number".format(field))
+        if field == "latitude" and not -90.0 <= value <= 90.0 or \
+                field == "longitude" and not -180.0 <= value <= 180.0:
+            raise ValueError("{} {} is out of range".format(field, value))
+        return value
+
+    def start(self):
+        self._writer = threading.Thread(target=self._run, name="telemetry-bridge")
+        self._writer.daemon = True
+        self._writer.start()
+        if hasattr(self.mqtt_client, "loop_start"):
+            self.mqtt_client.loop_start()
+
+    def stop(self):
+        if hasattr(self.mqtt_client, "loop_stop"):
+            self.mqtt_client.loop_stop()
+        self._stopevent.set()
+        if self._writer is not None:
+            self._writer.join()
+        for device_uid in list(self._sessions):
+            self._close_session(device_uid)
+
+    def _run(self):
+        while not self._stopevent.is_set() or not self._queue.empty():
+            batch = self._next_batch()
+            if not batch:
+                continue
+            try:
+                self.store(batch)
+            except Exception as e:
+                # the writer must survive, or the network thread blocks forever on the full queue
+                self.failed += len(batch)
+                self.logger.exception("Telemetry bridge failed to store {} message(s): {}".format(len(batch), e))
+
+    def _next_batch(self):
+        try:
+            batch = [ self._queue.get(timeout=self.batch_max_age) ]
+        except queue.Empty:
+            return []
+
+        end = time.monotonic() + self.batch_max_age
+        while len(batch) < self.batch_size:
+            timeout = end - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _session(self, device_uid, date):
+        session, start_date, last_date = self._sessions.get(device_uid, (None, None, None))
+        if session is not None and (date - last_date).total_seconds() > self.session_timeout:
+            self._close_session(device_uid)
+            session = None
+
+        if session is None:
+            session = self.controller.create("mqtt://{}/{}".format(device_uid, date.isoformat()))
+            session.start(date)
+            start_date = date
+        self._sessions[ device_uid ] = (session, start_date, date)
+        return session, start_date
+
+    def _close_session(self, device_uid):
+        session, start_date, last_date = self._sessions.pop(device_uid)
+        self._latest.pop(device_uid, None)
+        self._last_sample.pop(device_uid, None)
+        self.logger.info("Closing telemetry session {} of device {}".format(session.uid, device_uid))
+        session.stop()
+
+    def store(self, batch):
+        for device_uid, date, fields in batch:
+            session, start_date = self._session(device_uid, date)
+            latest = self._latest.setdefault(device_uid, {})
+            latest.update(fields)
+
+            fix = "latitude" in fields and "longitude" in fields
+            last_sample = self._last_sample.get(device_uid)
+            if not fix and last_sample is not None and (date - last_sample).total_seconds() < self.sample_interval:
+                # merged into the next sample of the device
+                continue
+
+            sample = dict(latest, timestamp=(date - start_date).total_seconds())
+            latitude = sample.pop("latitude", 0.0)
+            longitude = sample.pop("longitude", 0.0)
+            session.new_car_data(latitude, longitude, **sample)
+            self._last_sample[ device_uid ] = date
+            self.samples += 1
+        self.db_driver.flush()
+
+        now = datetime.datetime.now()
+        for device_uid, date, fields in batch:
+            lag = (now - date).total_seconds()
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            self.total_lag += lag
+        self.committed += len(batch)
+        self.logger.debug("Telemetry bridge committed {} sample(s), lag {} s, queue depth {}".format(
+            len(batch), round(self.last_lag, 3), self.queue_depth))
@@ -1,3 +1,4 @@
+import contextlib
 import json
 import logging
 import threading
@@ -10,24 +11,128 @@ import os
 import paho.mqtt.client as mqtt #import the client1
 import sys
 
-class AutopialWorker(threading.Thread):
-    BROKER_ADDRESS = "localhost"
+from autopial_lib.metrics import metrics
+from autopial_lib.mqtt_spool import MQTTSpool
 
-    def __init__(self, mqtt_client_name, time_sleep=5, logger = None):
-        threading.Thread.__init__(self)
-        self.daemon = True
+def json_serializer(payload):
+    return json.dumps(payload, separators=(',', ':'))
+
+
+SERIALIZERS = {
+    "json": json_serializer
+}
+
+# MQTT client picked up by the AutopialWorker created in this thread without one, see shared_mqtt_client()
+_shared = threading.local()
+
+
+@contextlib.contextmanager
+def shared_mqtt_client(mqtt_client):
+    # AutopialWorker instances created in this block use mqtt_client instead of connecting,
+    # for subclasses whose __init__ does not take an mqtt_client argument
+    previous = getattr(_shared, "mqtt_client", None)
+    _shared.mqtt_client = mqtt_client
+    try:
+        yield mqtt_client
+    finally:
+        _shared.mqtt_client = previous
+
+
+class TopicRateLimiter():
+    """At most one message per topic every 'interval' seconds (monotonic clock).
+
+    A value offered inside the window is kept as pending, replacing any previous pending
+    value of that topic, and is returned by due() once the window is over.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._last_dates = {}
+        self._pending = {}
+        # monotonic date at which the first pending value can be sent
+        self._next_due_date = None
+        self._lock = threading.Lock()
+
+    def offer(self, topic, value):
+        now = time.monotonic()
+        with self._lock:
+            last_date = self._last_dates.get(topic)
+            if last_date is None or now - last_date >= self.interval:
+                self._last_dates[ topic ] = now
+                self._pending.pop(topic, None)
+                return True
+
+            self._pending[ topic ] = value
+            due_date = last_date + self.interval
+            if self._next_due_date is None or due_date < self._next_due_date:
+                self._next_due_date = due_date
+            return False
+
+    def sent(self, topic):
+        with self._lock:
+            self._last_dates[ topic ] = time.monotonic()
+            self._pending.pop(topic, None)
+
+    def due(self):
+        if self._next_due_date is None or time.monotonic() < self._next_due_date:
+            return []
+
+        due = []
+        with self._lock:
+            now = time.monotonic()
+            self._next_due_date = None
+            for topic in list(self._pending):
+                due_date = self._last_dates[ topic ] + self.interval
+                if now >= due_date:
+                    due.append((topic, self._pending.pop(topic)))
+                    self._last_dates[ topic ] = now
+                elif self._next_due_date is None or due_date < self._next_due_date:
+                    self._next_due_date = due_date
+        return due
+
+    def next_due(self):
+        # seconds until the first pending value can be sent, None without pending value
+        next_due_date = self._next_due_date
+        if next_due_date is None:
+            return None
+        return max(0.0, next_due_date - time.monotonic())
+
+
+class AutopialPublisher():
+    """Publishing side shared by the threaded and the asyncio workers: metadata envelope,
+    per-topic throttling with coalescing and serialization. Subclasses provide mqtt_client.
+
+    With a spool (an MQTTSpool or the path of its file), messages that cannot be sent
+    because the broker is unreachable are stored on disk and replayed in order once it is back.
+    """
+
+    def __init__(self, mqtt_client_name, time_sleep=5, logger=None, serializer="json", spool=None):
         if logger is None:
             self.logger = logging.getLogger(__name__)
         else:
             self.logger = logger
 
-        self.logger.info("New AutopialWorker: '{}' publishing every {}secs".format(mqtt_client_name, time_sleep))
-        self.time_sleep = time_sleep
-        self._stopevent = threading.Event( )
+        self._rate_limiter = TopicRateLimiter(time_sleep)
         self._one_time_force = True
-        self._last_publish_dates = {}
         self.client_name = mqtt_client_name
-        self.mqtt_connect(mqtt_client_name)
+        if callable(serializer):
+            self.serializer = serializer
+        else:
+            self.serializer = SERIALIZERS[ serializer ]
+        # process wide metadata, computed once instead of on every publish
+        self._metadata = self.autopial_metadata()
+        self.mqtt_client = None
+        if spool is not None and not isinstance(spool, MQTTSpool):
+            spool = MQTTSpool(spool, logger=self.logger)
+        self.spool = spool
+
+    @property
+    def time_sleep(self):
+        return self._rate_limiter.interval
+
+    @time_sleep.setter
+    def time_sleep(self, value):
+        self._rate_limiter.interval = value
 
     def autopial_metadata(self):
         md = {
@@ -38,11 +143,104 @@ class AutopialWorker(threading.Thread):
         }
         return md
 
+    def publish(self, topic, value, ignore_timer=False):
+        if ignore_timer is False:
+            self.publish_pending()
+            if not self._rate_limiter.offer(topic, value):
+                # coalesced: only the latest value is sent when the topic window closes
+                return
+        else:
+            self._rate_limiter.sent(topic)
+        self._send(topic, value)
+
+    def publish_pending(self):
+        for topic, value in self._rate_limiter.due():
+            self._send(topic, value)
+
+    def _send(self, topic, value):
+        now = datetime.datetime.now()
+        if isinstance(value, dict):
+            value["datetime"] = now.isoformat(' ')
+            value["topic"] = topic
+            value["autopial"] = self._metadata
+        else:
+            value = {
+                "topic": topic,
+                "value": value,
+                "datetime" : now.isoformat(),
+                "autopial" : self._metadata
+            }
+
+        with metrics.timer("mqtt.serialize"):
+            payload = self.serializer(value)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("MQTT Publish: {} = {}".format(topic, payload))
+        with metrics.timer("mqtt.publish"):
+            if self.spool is None:
+                self.mqtt_client.publish(topic,
+                                         payload=payload,
+                                         qos=0,
+                                         retain=True)
+            else:
+                self.spool.send(self._mqtt_publish, topic, payload, retain=True)
+
+    def _mqtt_publish(self, topic, payload, retain):
+        if not self.mqtt_client.is_connected():
+            return False
+        info = self.mqtt_client.publish(topic, payload=payload, qos=0, retain=retain)
+        return info.rc == mqtt.MQTT_ERR_SUCCESS
+
+    def replay_spool(self, batch_size=100):
+        # True when the spool has been emptied
+        sent = self.spool.replay(self._mqtt_publish, batch_size=batch_size)
+        if sent:
+            self.logger.info("{} replayed {} spooled message(s), {} left".format(self.client_name, sent, len(self.spool)))
+        return len(self.spool) == 0
+
+    def _wait_timeout(self, end):
+        # time to block before the next wake up: end of the sleep or a coalesced value to send
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            return None
+        next_due = self._rate_limiter.next_due()
+        if next_due is not None and next_due < remaining:
+            return next_due
+        return remaining
+
+
+class AutopialWorker(AutopialPublisher, threading.Thread):
+    BROKER_ADDRESS = "localhost"
+
+    def __init__(self, mqtt_client_name, time_sleep=5, logger = None, serializer="json", mqtt_client=None,
+                 spool=None):
+        threading.Thread.__init__(self)
+        AutopialPublisher.__init__(self, mqtt_client_name, time_sleep=time_sleep, logger=logger,
+                                   serializer=serializer, spool=spool)
+        self.daemon = True
+
+        self.logger.info("New AutopialWorker: '{}' publishing every {}secs".format(mqtt_client_name, time_sleep))
+        self._stopevent = threading.Event( )
+        if mqtt_client is None:
+            mqtt_client = getattr(_shared, "mqtt_client", None)
+        if mqtt_client is None:
+            self.mqtt_connect(mqtt_client_name)
+        else:
+            # connection shared with other workers, e.g. by AutopialScheduler
+            self.mqtt_client = mqtt_client
 
     def mqtt_connect(self, mqtt_client_name):
         #self.client_name = "{}-{}".format(mqtt_client_name, uuid.uuid4().hex)
         self.logger.info("Connection to MQTT broker: '{}' with name '{}'".format(self.BROKER_ADDRESS, self.client_name))
         self.mqtt_client = mqtt.Client(self.client_name)
+        if self.spool is not None:
+            # no need for the broker to be up: paho keeps reconnecting and publishes are spooled meanwhile
+            self.mqtt_client.on_connect = self._on_connect
+            self.mqtt_client.reconnect_delay_set(min_delay=1, max_delay=60)
+            self.mqtt_client.connect_async(self.BROKER_ADDRESS, port=1883, keepalive=60)
+            self.mqtt_client.loop_start()
+            self.logger.info("  => connecting in background, spooling to '{}'".format(self.spool.filepath))
+            return
+
         try:
             self.mqtt_client.connect(self.BROKER_ADDRESS, port=1883, keepalive=60)
         except ConnectionRefusedError as e:
@@ -51,53 +249,34 @@ class AutopialWorker(threading.Thread):
 
         self.logger.info("  => successful !")
 
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            self.logger.info("{} connected to MQTT broker".format(self.client_name))
+            self.replay_spool()
+
     def run(self):
         self.logger.error("Define a run() method from an inherited class of AutopialWorker")
 
-    def publish(self, topic, value, ignore_timer=False):
-        if ignore_timer is False:
-            if topic not in self._last_publish_dates:
-                self._last_publish_dates[topic] = datetime.datetime.now()
-            else:
-                if self._last_publish_dates[topic] + datetime.timedelta(seconds=self.time_sleep) > datetime.datetime.now():
-                    return
-
-        if isinstance(value, dict):
-            value["datetime"] = datetime.datetime.now().isoformat(' ')
-            value["topic"] = topic
-            value["autopial"] = self.autopial_metadata()
-        else:
-            value = {
-                "topic": topic,
-                "value": value,
-                "datetime" : datetime.datetime.now().isoformat(),
-                "autopial" : self.autopial_metadata()
-            }
-
-        value = json.dumps(value)
-        self.logger.info("MQTT Publish: {} = {}".format(topic, value))
-        self.mqtt_client.publish(topic,
-                                 payload=value,
-                                 qos=0,
-                                 retain=True)
-        self._last_publish_dates[topic] = datetime.datetime.now()
-
     def wait(self):
         if self._one_time_force == True:
             self._one_time_force = False
         else:
             self.logger.debug("{} sleeping for {} seconds".format(self.client_name, self.time_sleep))
-            first_dt = datetime.datetime.now()
-            dt = datetime.datetime.now()
-            while (dt - first_dt).total_seconds() < self.time_sleep and not self._stopevent.isSet():
-                time.sleep(0.2)
-                dt = datetime.datetime.now()
-        return not self._stopevent.isSet()
+            end = time.monotonic() + self.time_sleep
+            while not self._stopevent.is_set():
+                timeout = self._wait_timeout(end)
+                if timeout is None:
+                    break
+                # wakes up immediately on stop(), or to send coalesced values when their window closes
+                if self._stopevent.wait(timeout):
+                    break
+                self.publish_pending()
+        return not self._stopevent.is_set()
 
     def next(self):
-        return not self._stopevent.isSet()
+        return not self._stopevent.is_set()
 
     def stop(self):
         self._stopevent.set( )
-
-
+        if self.spool is not None:
+            self.spool.sync()
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Offline benchmarks of the ingestion, parsing, publishing and termination paths.
+
+    python -m benchmarks.run_benchmarks --rows 50000
+    python -m benchmarks.run_benchmarks --save-baseline      # record the reference numbers of this machine
+    python -m benchmarks.run_benchmarks                      # compare with them
+
+Everything runs in process: synthetic Torque CSV files, mongomock (or a local mongod with
+--db-path mongodb://localhost:27017/), the fake MQTT broker of autopial_lib.fake_mqtt and
+an offline geocoder. Each benchmark runs in its own spawned process so the reported peak
+RSS is its own. Numbers only mean something compared with a baseline recorded on the
+same machine.
+
+mongomock is not a dependency of the library, install it with:
+
+    pip install -r benchmarks/requirements_pip
+"""
+import argparse
+import datetime
+import json
+import logging
+import math
+import multiprocessing
+import os
+import queue
+import random
+import resource
+import sys
+import tempfile
+import time
+import traceback
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+TORQUE_HEADER = [ "GPS Time", " Device Time", " Longitude", " Latitude", "GPS Speed (Meters/second)",
+                  " Altitude", " Bearing", " G(x)", " G(y)", " G(z)", "Engine RPM(rpm)", "Speed (OBD)(km/h)",
+                  "Engine Coolant Temperature(°C)" ]
+TORQUE_MONTHS = [ "janv.", "févr.", "mars", "avr.", "mai", "juin", "juil.", "août", "sept.", "oct.", "nov.", "déc." ]
+
+# metrics where a higher value is better, every other metric is better lower
+THROUGHPUT_SUFFIX = "_per_second"
+
+
+def write_torque_csv(filepath, rows, seed=0, period=0.1):
+    # Torque log of a drive going north-east at 10 Hz, with '-' placeholders like real logs
+    rnd = random.Random(seed)
+    start = datetime.datetime(2016, 5, 11, 20, 23, 42)
+    with open(filepath, 'w', encoding='utf-8') as f:
+        f.write(",".join(TORQUE_HEADER) + "\n")
+        for i in range(rows):
+            dt = start + datetime.timedelta(seconds=i * period)
+            device_time = "{:02d}-{}-{} {}.{:03d}".format(dt.day, TORQUE_MONTHS[ dt.month - 1 ], dt.year,
+                                                          dt.strftime("%H:%M:%S"), dt.microsecond // 1000)
+            f.write(",".join([ dt.strftime("%a %b %d %H:%M:%S GMT+02:00 %Y"), device_time,
+                               "{:.6f}".format(5 + i * 2e-5), "{:.6f}".format(45 + i * 2e-5 + 1e-4 * math.sin(i / 50)),
+                               "{:.2f}".format(rnd.uniform(10, 30)), "{:.1f}".format(200 + rnd.random()),
+                               "{:.1f}".format(45 + rnd.uniform(-5, 5)),
+                               "{:.4f}".format(rnd.gauss(0, 0.1)), "{:.4f}".format(rnd.gauss(0, 0.1)), "-",
+                               "{:.0f}".format(rnd.uniform(800, 3500)), "{:.0f}".format(rnd.uniform(0, 130)),
+                               "{:.0f}".format(rnd.uniform(85, 110)) ]) + "\n")
+    return filepath
+
+
+def percentiles(latencies):
+    # p50/p99 in milliseconds
+    if not latencies:
+        return dict(p50_ms=None, p99_ms=None)
+    latencies = sorted(latencies)
+    return dict(p50_ms=latencies[ len(latencies) // 2 ] * 1000,
+                p99_ms=latencies[ min(len(latencies) - 1, int(len(latencies) * 0.99)) ] * 1000)
+
+
+def car_driver(db_path, **kwargs):
+    from autopial_lib.MongoDatabaseDriver import MongoClients
+    from autopial_lib.MongoDatabaseDriver.CarDriver import CarDriver
+
+    if db_path == "mongomock":
+        import mongomock
+        MongoClients.MongoClient = mongomock.MongoClient
+        db_name = "autopial-bench"
+    else:
+        db_name = "autopial-bench-{}".format(os.getpid())
+    driver = CarDriver(db_path, db_name, **kwargs)
+    if db_path != "mongomock":
+        driver.database.client.drop_database(db_name)
+        driver.ensure_indexes()
+    return driver
+
+
+def car_controller(driver):
+    from autopial_lib.Controller.CarController import CarController
+    from autopial_lib.Controller.Geocoding import OfflineGeocoder
+
+    return CarController(driver, geocoder=OfflineGeocoder())
+
+
+def bench_torque_parse(args, workdir):
+    from autopial_lib.TorqueDriver import TorqueFileReader
+
+    filepath = write_torque_csv(os.path.join(workdir, "torque.csv"), args.rows)
+    start = time.perf_counter()
+    rows = sum(1 for line in TorqueFileReader(filepath).readline())
+    readline_duration = time.perf_counter() - start
+
+    start = time.perf_counter()
+    array = TorqueFileReader(filepath).read_array(cache=False)
+    read_array_duration = time.perf_counter() - start
+    return dict(rows=rows,
+                readline_rows_per_second=rows / readline_duration,
+                read_array_rows_per_second=len(array) / read_array_duration)
+
+
+def bench_ingest(args, workdir):
+    driver = car_driver(args.db_path, buffered=True, buffer_size=500, storage=args.storage)
+    controller = car_controller(driver)
+    session = controller.create("bench://ingest")
+    session.start(datetime.datetime(2016, 5, 11, 20, 23, 42))
+
+    latencies = []
+    start = time.perf_counter()
+    for i in range(args.rows):
+        t = time.perf_counter()
+        session.new_car_data(45 + i * 2e-5, 5 + i * 2e-5, timestamp=i * 0.1, rpm=2000.0, obd_speed=50.0,
+                             coolant_temp=90.0, accel_x=0.01, accel_y=0.02, accel_z=1.0)
+        latencies.append(time.perf_counter() - t)
+    session.flush()
+    duration = time.perf_counter() - start
+    controller.close(wait=False)
+    return dict(samples=args.rows, samples_per_second=args.rows / duration, **percentiles(latencies))
+
+
+def bench_publish(args, workdir):
+    from autopial_lib.fake_mqtt import FakeBroker
+    from autopial_lib.thread_worker import AutopialWorker
+
+    broker = FakeBroker()
+    subscriber = broker.client("bench-subscriber")
+    subscriber.connect()
+    subscriber.subscribe("autopial/#")
+    received = []
+    subscriber.on_message = lambda client, userdata, message: received.append(len(message.payload))
+
+    client = broker.client("bench-worker")
+    client.connect()
+    worker = AutopialWorker("bench-worker", time_sleep=0, mqtt_client=client)
+
+    latencies = []
+    start = time.perf_counter()
+    for i in range(args.publishes):
+        t = time.perf_counter()
+        worker.publish("autopial/bench/{}".format(i % 16), {"value": float(i), "unit": "km/h"}, ignore_timer=True)
+        latencies.append(time.perf_counter() - t)
+    duration = time.perf_counter() - start
+    return dict(publishes=args.publishes, received=len(received),
+                publishes_per_second=args.publishes / duration, **percentiles(latencies))
+
+
+def bench_terminate(args, workdir):
+    driver = car_driver(args.db_path, buffered=True, buffer_size=500, storage=args.storage)
+    controller = car_controller(driver)
+
+    latencies = []
+    for n in range(args.sessions):
+        session = controller.create("bench://terminate/{}".format(n))
+        session.start(datetime.datetime(2016, 5, 11, 20, 23, 42))
+        for i in range(args.session_rows):
+            session.new_car_data(45 + i * 1e-4, 5 + i * 1e-4, timestamp=i * 0.1, rpm=2000.0)
+        t = time.perf_counter()
+        session.stop()
+        latencies.append(time.perf_counter() - t)
+    controller.close(wait=False)
+    return dict(sessions=args.sessions,
+                sessions_per_second=args.sessions / sum(latencies), **percentiles(latencies))
+
+
+BENCHMARKS = {
+    "torque_parse": bench_torque_parse,
+    "ingest": bench_ingest,
+    "publish": bench_publish,
+    "terminate": bench_terminate,
+}
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def _run_one(name, args, results):
+    logging.disable(logging.CRITICAL)
+    os.environ.setdefault("AUTOPIAL_UID", "benchmark")
+    os.environ.setdefault("AUTOPIAL_NAME", "benchmark")
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            result = BENCHMARKS[ name ](args, workdir)
+        # kilobytes on Linux
+        result[ "peak_rss_mb" ] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    except BaseException:
+        # reported by the parent process
+        results.put((False, traceback.format_exc()))
+        return
+    results.put((True, result))
+
+
+def run(name, args):
+    # result of the benchmark, BenchmarkError when its process fails, dies or times out
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=_run_one, args=(name, args, results))
+    process.start()
+    deadline = time.monotonic() + args.timeout
+    try:
+        while True:
+            try:
+                ok, result = results.get(timeout=1.0)
+                break
+            except queue.Empty:
+                if not process.is_alive():
+                    raise BenchmarkError("process exited with code {} without a result".format(process.exitcode))
+                if time.monotonic() > deadline:
+                    raise BenchmarkError("timed out after {} s".format(args.timeout))
+    finally:
+        if process.is_alive():
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+        process.join()
+
+    if not ok:
+        raise BenchmarkError(result)
+    return result
+
+
+def compare(results, baseline, tolerance):
+    # {benchmark: {metric: relative change}} of the metrics worse than the baseline by more than tolerance
+    regressions = {}
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            reference = baseline.get(name, {}).get(metric)
+            if not isinstance(value, float) or not reference:
+                continue
+            change = (value - reference) / reference
+            worse = -change if metric.endswith(THROUGHPUT_SUFFIX) else change
+            if worse > tolerance:
+                regressions.setdefault(name, {})[ metric ] = change
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline autopial-lib benchmarks")
+    parser.add_argument("--rows", type=int, default=20000, help="Torque rows and ingested samples")
+    parser.add_argument("--publishes", type=int, default=50000)
+    parser.add_argument("--sessions", type=int, default=20, help="sessions terminated")
+    parser.add_argument("--session-rows", type=int, default=500, help="samples per terminated session")
+    parser.add_argument("--db-path", default="mongomock", help="'mongomock' or a MongoDB URI")
+    parser.add_argument("--storage", default="document", choices=("document", "bucket"))
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="relative change reported as a regression")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--timeout", type=float, default=1800, help="seconds allowed to each benchmark")
+    parser.add_argument("benchmarks", nargs="*", help="benchmarks to run among {}, all by default".format(
+        ", ".join(sorted(BENCHMARKS))))
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark '{}'".format(name))
+
+    results = {}
+    failures = []
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        try:
+            results[ name ] = run(name, args)
+        except BenchmarkError as e:
+            failures.append(name)
+            print("{:<14} FAILED: {}".format(name, e))
+            continue
+        print("{:<14} {}".format(name, ", ".join("{}={}".format(k, round(v, 3) if isinstance(v, float) else v)
+                                               for k, v in results[ name ].items())))
+    if failures:
+        # an incomplete run is neither a baseline nor a comparison
+        print("{} benchmark(s) failed: {}".format(len(failures), ", ".join(failures)))
+        sys.exit(2)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Baseline saved to '{}'".format(args.baseline))
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for name, metrics in regressions.items():
+            for metric, change in metrics.items():
+                print("REGRESSION {} {}: {:+.1%}".format(name, metric, change))
+        if regressions:
+            sys.exit(1)
+        print("No regression against '{}' (tolerance {:.0%})".format(args.baseline, args.tolerance))
+    else:
+        print("No baseline at '{}', run with --save-baseline to record one".format(args.baseline))